@@ -0,0 +1,179 @@
+import logging
+import os
+import re
+import threading
+import urllib.parse
+import zipfile
+
+from proxies import PooledYoutubeDL, source_for_url
+
+URL_PATTERN = re.compile(r'https?://\S+')
+
+SUPPORTED_HOSTS = ('youtube.com', 'youtu.be', 'dailymotion.com', 'dai.ly', 'tiktok.com')
+
+# Pages that list videos rather than being one
+PLAYLIST_PATH_PATTERN = re.compile(r'^/(playlist|@[^/]+|channel/|c/|user/)')
+
+# yt-dlp extractors whose flat entries are single videos; anything else is a listing
+VIDEO_EXTRACTORS = ('Youtube', 'Dailymotion', 'TikTok')
+
+# How many levels of listings to follow, e.g. channel -> Videos tab
+MAX_LISTING_DEPTH = 2
+
+
+def find_links(text):
+    """Return the supported links in a message, in order and without duplicates."""
+    links = []
+    for url in URL_PATTERN.findall(text or ''):
+        url = url.rstrip('.,;)')
+        if any(host in url for host in SUPPORTED_HOSTS) and url not in links:
+            links.append(url)
+    return links
+
+
+def is_playlist_url(url):
+    parts = urllib.parse.urlparse(url)
+    if 'dailymotion.com' in parts.netloc:
+        return parts.path.startswith('/playlist/')
+    if 'youtube.com' in parts.netloc:
+        return bool(PLAYLIST_PATH_PATTERN.match(parts.path))
+    return False
+
+
+def expand_links(links, max_items, proxy_pool):
+    """Expand playlist and channel links into video URLs with flat extraction.
+
+    Flat extraction only reads the listing, so a playlist costs one request
+    instead of a full extraction per video. Returns at most max_items URLs.
+    """
+    ydl_opts = {
+        'quiet': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': max_items,
+    }
+    urls = []
+    for link in links:
+        if len(urls) >= max_items:
+            break
+        if not is_playlist_url(link):
+            urls.append(link)
+            continue
+        with PooledYoutubeDL(proxy_pool, source_for_url(link), ydl_opts) as ydl:
+            info = ydl.extract_info(link, download=False)
+            for entry in _video_entries(ydl, info, MAX_LISTING_DEPTH):
+                url = entry.get('webpage_url') or entry.get('url')
+                if url and not url.startswith('http') and entry.get('id'):
+                    url = f"https://www.youtube.com/watch?v={entry['id']}"
+                if url and url not in urls:
+                    urls.append(url)
+                if len(urls) >= max_items:
+                    break
+    return urls[:max_items]
+
+
+def _video_entries(ydl, info, depth):
+    """Yield the flat entries of info that are single videos.
+
+    Channel pages list their tabs (Videos, Shorts, ...) as url entries of
+    their own; those are flat-extracted in turn, depth levels deep, instead
+    of being handed out as one "video" that would download the whole tab.
+    """
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        if entry.get('_type') == 'playlist' or entry.get('entries'):
+            yield from _video_entries(ydl, entry, depth)
+        elif entry.get('ie_key') in VIDEO_EXTRACTORS:
+            yield entry
+        elif depth > 0 and entry.get('url'):
+            yield from _video_entries(ydl, ydl.extract_info(entry['url'], download=False), depth - 1)
+        else:
+            logging.debug("Skipping playlist entry %s", entry.get('url'))
+
+
+class BatchItem:
+    def __init__(self, index, url):
+        self.index = index
+        self.url = url
+        self.file_path = None
+        self.error = None
+
+
+class Batch:
+    """A group of downloads for one user, run with bounded parallelism.
+
+    At most `parallelism` items are handed to submit(item) at a time; each
+    must eventually report back through item_done(). When the last item is
+    done, on_complete(batch) is called.
+    """
+
+    def __init__(self, user_id, urls, submit, on_complete, on_progress=None, parallelism=3):
+        self.user_id = user_id
+        self.items = [BatchItem(i, url) for i, url in enumerate(urls)]
+        self.parallelism = parallelism
+        self._submit = submit
+        self._on_complete = on_complete
+        self._on_progress = on_progress
+        self._next = 0
+        self._done = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            to_submit = self._take(self.parallelism)
+        for item in to_submit:
+            self._submit_item(item)
+        if not self.items:
+            self._on_complete(self)
+
+    def item_done(self, item, file_path=None, error=None):
+        item.file_path = file_path
+        item.error = error
+        with self._lock:
+            self._done += 1
+            finished = self._done == len(self.items)
+            to_submit = self._take(1)
+        if self._on_progress is not None:
+            self._on_progress(self)
+        for next_item in to_submit:
+            self._submit_item(next_item)
+        if finished:
+            self._on_complete(self)
+
+    def done_count(self):
+        return self._done
+
+    def succeeded(self):
+        return [item for item in self.items if item.file_path]
+
+    def failed(self):
+        return [item for item in self.items if item.error]
+
+    def _take(self, count):
+        """Pop up to count items that have not been submitted yet. Caller holds the lock."""
+        items = self.items[self._next:self._next + count]
+        self._next += len(items)
+        return items
+
+    def _submit_item(self, item):
+        try:
+            self._submit(item)
+        except Exception as e:
+            logging.error("Could not queue batch item %s: %s", item.url, e)
+            self.item_done(item, error=str(e))
+
+
+def write_archive(archive_path, file_paths):
+    """Pack files into a zip archive. Videos are already compressed, so they are stored as is."""
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        names = set()
+        for path in file_paths:
+            name = os.path.basename(path)
+            base, ext = os.path.splitext(name)
+            counter = 1
+            while name in names:
+                name = f"{base}_{counter}{ext}"
+                counter += 1
+            names.add(name)
+            archive.write(path, arcname=name)
+    return archive_path
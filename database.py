@@ -4,9 +4,6 @@ from psycopg2.extras import DictCursor
 from datetime import datetime
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
 # Load environment variables from .env file (even if you are not using .env, Railway will provide the variables)
 PGUSER = os.getenv('PGUSER')
 PGPASSWORD = os.getenv('POSTGRES_PASSWORD')  # Update to POSTGRES_PASSWORD
@@ -17,13 +14,7 @@ PGPORT = os.getenv('PGPORT')
 def connect_db():
     """Establish a connection to the PostgreSQL database."""
     try:
-        logging.debug("Connecting to the database with the following settings:")
-        logging.debug(f"PGUSER: {PGUSER}")
-        logging.debug(f"PGPASSWORD: {'******' if PGPASSWORD else 'None'}")
-        logging.debug(f"PGHOST: {PGHOST}")
-        logging.debug(f"PGDATABASE: {PGDATABASE}")
-        logging.debug(f"PGPORT: {PGPORT}")
-        
+        logging.debug("Connecting to database %s on %s:%s as %s", PGDATABASE, PGHOST, PGPORT, PGUSER)
         conn = psycopg2.connect(
             user=PGUSER,
             password=PGPASSWORD,
@@ -32,10 +23,9 @@ def connect_db():
             port=PGPORT,
             cursor_factory=DictCursor
         )
-        logging.debug("Database connection established successfully")
         return conn
     except psycopg2.Error as e:
-        logging.error(f"Error connecting to database: {e}")
+        logging.error("Error connecting to database: %s", e)
         return None
 
 def create_user_downloads_table(conn):
@@ -52,7 +42,7 @@ def create_user_downloads_table(conn):
         conn.commit()
         logging.debug("Table user_downloads created successfully")
     except psycopg2.Error as e:
-        logging.error(f"Error creating user_downloads table: {e}")
+        logging.error("Error creating user_downloads table: %s", e)
 
 def ensure_user_in_db(conn, user_id):
     """Ensure the user exists in the database."""
@@ -64,9 +54,9 @@ def ensure_user_in_db(conn, user_id):
             ON CONFLICT (user_id) DO NOTHING
         """, (user_id, 0, datetime.now().date()))
         conn.commit()
-        logging.debug(f"User {user_id} ensured in the database")
+        logging.debug("User %s ensured in the database", user_id)
     except psycopg2.Error as e:
-        logging.error(f"Error ensuring user in database: {e}")
+        logging.error("Error ensuring user in database: %s", e)
 
 def get_download_count(conn, user_id):
     """Get the download count for a user."""
@@ -74,10 +64,10 @@ def get_download_count(conn, user_id):
         cursor = conn.cursor()
         cursor.execute("SELECT download_count FROM user_downloads WHERE user_id = %s", (user_id,))
         result = cursor.fetchone()
-        logging.debug(f"Download count for user {user_id}: {result['download_count'] if result else 0}")
+        logging.debug("Download count for user %s: %s", user_id, result['download_count'] if result else 0)
         return result['download_count'] if result else 0
     except psycopg2.Error as e:
-        logging.error(f"Error getting download count: {e}")
+        logging.error("Error getting download count: %s", e)
         return 0
 
 def increment_download_count(conn, user_id):
@@ -91,9 +81,51 @@ def increment_download_count(conn, user_id):
             WHERE user_id = %s
         """, (datetime.now().date(), user_id))
         conn.commit()
-        logging.debug(f"Incremented download count for user {user_id}")
+        logging.debug("Incremented download count for user %s", user_id)
+    except psycopg2.Error as e:
+        logging.error("Error incrementing download count: %s", e)
+
+def reserve_download_count(conn, user_id, requested, limit):
+    """Count up to requested downloads against the daily limit at once.
+
+    The row is locked while reading and updating, so concurrent batches and
+    single downloads can't all see the same remaining allowance. Returns how
+    many downloads were granted.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT download_count FROM user_downloads WHERE user_id = %s FOR UPDATE", (user_id,))
+        result = cursor.fetchone()
+        count = result['download_count'] if result else 0
+        granted = max(min(requested, limit - count), 0)
+        if granted:
+            cursor.execute("""
+                UPDATE user_downloads
+                SET download_count = download_count + %s,
+                    last_download_date = %s
+                WHERE user_id = %s
+            """, (granted, datetime.now().date(), user_id))
+        conn.commit()
+        logging.debug("Reserved %s of %s downloads for user %s", granted, requested, user_id)
+        return granted
+    except psycopg2.Error as e:
+        conn.rollback()
+        logging.error("Error reserving download count: %s", e)
+        return 0
+
+def refund_download_count(conn, user_id, amount):
+    """Give back downloads reserved with reserve_download_count that did not happen."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE user_downloads
+            SET download_count = GREATEST(download_count - %s, 0)
+            WHERE user_id = %s
+        """, (amount, user_id))
+        conn.commit()
+        logging.debug("Refunded %s downloads to user %s", amount, user_id)
     except psycopg2.Error as e:
-        logging.error(f"Error incrementing download count: {e}")
+        logging.error("Error refunding download count: %s", e)
 
 def reset_database():
     """Reset the user_downloads table in the database."""
@@ -108,5 +140,5 @@ def reset_database():
         logging.debug("Database reset successfully")
         return True
     except psycopg2.Error as e:
-        logging.error(f"Error resetting database: {e}")
+        logging.error("Error resetting database: %s", e)
         return False
@@ -0,0 +1,139 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# Correlation id of the job the current thread is working on
+_job_id = contextvars.ContextVar('job_id', default=None)
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(job_id)s] %(message)s"
+
+_listener = None
+
+
+@contextlib.contextmanager
+def job_context(job_id):
+    """Tag every log record emitted inside the block with job_id."""
+    token = _job_id.set(job_id)
+    try:
+        yield
+    finally:
+        _job_id.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    """Attach the current job id to each record."""
+
+    def filter(self, record):
+        record.job_id = _job_id.get() or '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of DEBUG records, everything at INFO and above passes."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'job_id': getattr(record, 'job_id', '-'),
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        elif record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full.
+
+    Unlike the stock QueueHandler the message is not formatted here: the
+    %-style arguments are kept and only merged on the listener thread, so the
+    thread that logs pays for little more than a queue put.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            # Tracebacks reference live frames, render them while they are valid
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped != self._reported:
+            lost = self.dropped - self._reported
+            self._reported = self.dropped
+            notice = logging.LogRecord('logconfig', logging.WARNING, __file__, 0,
+                                       "Dropped %d log records, log queue was full", (lost,), None)
+            notice.job_id = '-'
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                pass
+
+
+def configure_logging():
+    """Configure the root logger from the LOG_* environment variables.
+
+    LOG_LEVEL      minimum level, INFO by default
+    LOG_FORMAT     'text' or 'json'
+    LOG_SAMPLE_RATE  fraction of DEBUG records to keep
+    LOG_QUEUE_SIZE   records buffered before new ones are dropped
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    log_format = os.getenv('LOG_FORMAT', 'text').lower()
+    sample_rate = float(os.getenv('LOG_SAMPLE_RATE', 1.0))
+    queue_size = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if log_format == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    queue_handler = BoundedQueueHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    queue_handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
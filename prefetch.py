@@ -0,0 +1,302 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import deque
+
+
+class PrefetchAborted(Exception):
+    """Raised from a progress hook to stop a prefetch when real work arrives."""
+
+
+class PopularityTracker:
+    """Sliding-window request counts per video and per (video, format).
+
+    Keys are (source, video_id) for videos and (source, video_id, format_id)
+    for formats. Counts only cover the last `window` seconds.
+    """
+
+    def __init__(self, window=3600, threshold=5, max_keys=10000):
+        self.window = window
+        self.threshold = threshold
+        self.max_keys = max_keys
+        self._videos = {}
+        self._formats = {}
+        self._lock = threading.Lock()
+
+    def record_video(self, source, video_id):
+        self._record(self._videos, (source, video_id))
+
+    def record_format(self, source, video_id, format_id):
+        self._record(self._videos, (source, video_id))
+        self._record(self._formats, (source, video_id, format_id))
+
+    def hot_formats(self, formats_per_video=2):
+        """Return (source, video_id, format_id) keys worth prefetching, most popular video first."""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            hot_videos = sorted(((len(hits), key) for key, hits in self._videos.items()
+                                 if len(hits) >= self.threshold), reverse=True)
+            by_video = {}
+            for key, hits in self._formats.items():
+                by_video.setdefault(key[:2], []).append((len(hits), key))
+        result = []
+        for _, video in hot_videos:
+            formats = sorted(by_video.get(video, []), reverse=True)
+            result.extend(key for _, key in formats[:formats_per_video])
+        return result
+
+    def _record(self, table, key):
+        now = time.monotonic()
+        with self._lock:
+            hits = table.get(key)
+            if hits is None:
+                if len(table) >= self.max_keys:
+                    self._prune(now)
+                hits = table[key] = deque()
+            hits.append(now)
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+
+    def _prune(self, now):
+        """Drop hits that left the window and keys without hits. Caller holds the lock."""
+        cutoff = now - self.window
+        for table in (self._videos, self._formats):
+            for key in list(table):
+                hits = table[key]
+                while hits and hits[0] <= cutoff:
+                    hits.popleft()
+                if not hits:
+                    del table[key]
+
+
+class _CacheEntry:
+    def __init__(self, path, name, size):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.last_used = time.monotonic()
+
+
+class DownloadCache:
+    """Prefetched files on local disk, keyed by (source, video_id, format_id), evicted LRU.
+
+    The files live in a subdirectory of parent_dir that the cache creates
+    and owns (root); prefetches must download into it. Only files in root
+    are ever deleted, so a badly chosen parent_dir can't lose anything else.
+    """
+
+    DIR_NAME = "prefetch-cache"
+
+    def __init__(self, parent_dir, max_bytes):
+        self.root = os.path.join(parent_dir, self.DIR_NAME)
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        # The index lives in memory, files left over from a previous run are unknown
+        self.remove_untracked()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def size(self):
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def add(self, key, path, name):
+        """Take ownership of a downloaded file; name is the file name to hand out."""
+        size = os.path.getsize(path)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None and old.path != path:
+                self._delete(old)
+            self._entries[key] = _CacheEntry(path, name, size)
+            self._make_room(0)
+
+    def make_room(self, needed, keep=()):
+        """Evict least recently used entries, except those in keep, until needed more bytes fit.
+
+        Returns False, without evicting anything, if that is not possible.
+        """
+        with self._lock:
+            evictable = sum(entry.size for key, entry in self._entries.items() if key not in keep)
+            used = sum(entry.size for entry in self._entries.values())
+            if used - evictable + needed > self.max_bytes:
+                return False
+            self._make_room(needed, keep)
+        return True
+
+    def shrink(self, needed):
+        """Evict least recently used entries until needed bytes are freed. Returns the bytes freed."""
+        with self._lock:
+            freed = 0
+            for key, entry in sorted(self._entries.items(), key=lambda item: item[1].last_used):
+                if freed >= needed:
+                    break
+                del self._entries[key]
+                self._delete(entry)
+                freed += entry.size
+        if freed:
+            logging.info("Evicted %d bytes from the download cache to make room", freed)
+        return freed
+
+    def remove_untracked(self):
+        """Delete files in root that are not cache entries, e.g. partial downloads."""
+        with self._lock:
+            tracked = {entry.path for entry in self._entries.values()}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path in tracked or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error("Error deleting partial download %s: %s", path, e)
+
+    def checkout(self, key, dest_dir):
+        """Return a fresh copy of a cached file in dest_dir, or None on a miss.
+
+        The copy is a hard link where possible, so serving a cached file
+        costs no extra disk space and the pipeline may delete it freely.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry.path):
+                del self._entries[key]
+                return None
+            entry.last_used = time.monotonic()
+            source_path, name = entry.path, entry.name
+
+        base, ext = os.path.splitext(os.path.join(dest_dir, name))
+        dest = f"{base}{ext}"
+        counter = 1
+        while os.path.exists(dest):
+            dest = f"{base}_{counter}{ext}"
+            counter += 1
+        try:
+            os.link(source_path, dest)
+        except OSError:
+            shutil.copyfile(source_path, dest)
+        return dest
+
+    def _make_room(self, needed, keep=()):
+        """Caller holds the lock."""
+        used = sum(entry.size for entry in self._entries.values())
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1].last_used):
+            if used + needed <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            del self._entries[key]
+            self._delete(entry)
+            used -= entry.size
+
+    def _delete(self, entry):
+        try:
+            if os.path.exists(entry.path):
+                os.remove(entry.path)
+        except OSError as e:
+            logging.error("Error deleting cached file %s: %s", entry.path, e)
+
+
+class Prefetcher:
+    """Downloads popular formats into the cache while the download workers are idle.
+
+    fetch(key, ratelimit, progress_hook, make_room) must download key into
+    the cache directory and return (path, name), or None; partial files an
+    aborted or failed fetch leaves there are deleted. It should call
+    make_room(expected_bytes) first and give up if that returns False, so a
+    prefetch never pushes other popular files out of the cache. is_idle()
+    tells whether user work is waiting; a prefetch in progress is aborted
+    as soon as it returns False. Traffic is capped at ratelimit bytes per
+    second and bytes_per_hour in total.
+    """
+
+    def __init__(self, tracker, cache, fetch, is_idle, ratelimit=2 * 1024 * 1024,
+                 bytes_per_hour=2 * 1024 * 1024 * 1024, interval=30, retry_after=3600):
+        self.tracker = tracker
+        self.cache = cache
+        self.fetch = fetch
+        self.is_idle = is_idle
+        self.ratelimit = ratelimit
+        self.bytes_per_hour = bytes_per_hour
+        self.interval = interval
+        self.retry_after = retry_after
+        self._transfers = deque()  # (monotonic time, bytes) of recent prefetches
+        self._failed = {}  # key -> monotonic time of the last failure
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+            self._thread.start()
+
+    def bandwidth_left(self):
+        cutoff = time.monotonic() - 3600
+        while self._transfers and self._transfers[0][0] <= cutoff:
+            self._transfers.popleft()
+        return self.bytes_per_hour - sum(size for _, size in self._transfers)
+
+    def next_candidate(self, hot):
+        now = time.monotonic()
+        for key in hot:
+            if key in self.cache:
+                continue
+            if now - self._failed.get(key, -self.retry_after) < self.retry_after:
+                continue
+            return key
+        return None
+
+    def run_once(self):
+        """Prefetch at most one format. Returns True if something was downloaded."""
+        if not self.is_idle() or self.bandwidth_left() <= 0:
+            return False
+        hot = self.tracker.hot_formats()
+        key = self.next_candidate(hot)
+        if key is None:
+            return False
+        keep = set(hot)
+
+        def make_room(needed):
+            return self.cache.make_room(needed, keep)
+
+        downloaded = {}  # file name -> bytes, merged formats download several files
+
+        def progress_hook(d):
+            downloaded[d.get('filename')] = d.get('downloaded_bytes') or 0
+            if not self.is_idle():
+                raise PrefetchAborted("Download workers are busy")
+            if sum(downloaded.values()) > self.bandwidth_left():
+                raise PrefetchAborted("Prefetch bandwidth budget used up")
+
+        logging.info("Prefetching %s", key)
+        try:
+            result = self.fetch(key, self.ratelimit, progress_hook, make_room)
+        except Exception as e:
+            logging.info("Prefetch of %s stopped: %s", key, e)
+            result = None
+        self._transfers.append((time.monotonic(), sum(downloaded.values())))
+        if result is None:
+            self.cache.remove_untracked()
+            # Being interrupted by user work is not the format's fault, try again when idle
+            if self.is_idle():
+                self._failed[key] = time.monotonic()
+            return False
+        path, name = result
+        self.cache.add(key, path, name)
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                if not self.run_once():
+                    time.sleep(self.interval)
+            except Exception as e:
+                logging.error("Prefetcher error: %s", e, exc_info=True)
+                time.sleep(self.interval)
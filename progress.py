@@ -0,0 +1,248 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# Don't re-render on every yt-dlp callback, the hooks fire many times per second
+RENDER_INTERVAL = 0.5
+
+POSTPROCESSOR_LABELS = {
+    'Merger': "Merging video and audio",
+    'ExtractAudio': "Converting audio to MP3",
+    'FFmpegExtractAudio': "Converting audio to MP3",
+    'VideoConvertor': "Converting video",
+    'FFmpegVideoConvertor': "Converting video",
+    'FixupM3u8': "Fixing up the video container",
+    'MoveFiles': "Finishing up",
+}
+
+
+class RateLimiter:
+    """Token bucket shared by everything that edits messages."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        # Below one edit per second the bucket must still be able to hold a whole token
+        self.capacity = max(1.0, float(burst or rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds (e.g. after a 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                else:
+                    self._updated = self._paused_until
+                    delay = self._paused_until - now
+            time.sleep(delay)
+
+
+def format_bytes(num):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024 or unit == "GB":
+            return f"{num:.1f} {unit}" if unit != "B" else f"{int(num)} B"
+        num /= 1024.0
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def render_progress(label, d):
+    """Render a yt-dlp progress hook dict as a short status message."""
+    downloaded = d.get('downloaded_bytes') or 0
+    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+    lines = [f"{label}..."]
+    if total:
+        fraction = min(downloaded / total, 1.0)
+        filled = int(fraction * 10)
+        lines.append(f"[{'█' * filled}{'░' * (10 - filled)}] {fraction * 100:.0f}% of {format_bytes(total)}")
+    else:
+        lines.append(f"{format_bytes(downloaded)} downloaded")
+    details = []
+    if d.get('speed'):
+        details.append(f"{format_bytes(d['speed'])}/s")
+    if d.get('eta') is not None:
+        details.append(f"ETA {format_eta(d['eta'])}")
+    if details:
+        lines.append(", ".join(details))
+    return "\n".join(lines)
+
+
+class ProgressTracker:
+    """Turns yt-dlp progress and postprocessor hooks into updates for one status message."""
+
+    def __init__(self, reporter, chat_id, message_id, label):
+        self.reporter = reporter
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.label = label
+        self._last_render = 0.0
+        self._last_text = None
+
+    def progress_hook(self, d):
+        """Hook for the 'progress_hooks' yt-dlp option."""
+        status = d.get('status')
+        now = time.monotonic()
+        if status == 'downloading' and now - self._last_render < RENDER_INTERVAL:
+            return
+        self._last_render = now
+        if status == 'finished':
+            text = f"{self.label}...\nDownload finished, processing the file..."
+        elif status == 'error':
+            text = f"{self.label}...\nDownload failed."
+        else:
+            text = render_progress(self.label, d)
+        self.update(text)
+
+    def postprocessor_hook(self, d):
+        """Hook for the 'postprocessor_hooks' yt-dlp option, reports ffmpeg steps."""
+        if d.get('status') not in ('started', 'processing'):
+            return
+        name = d.get('postprocessor') or ''
+        step = POSTPROCESSOR_LABELS.get(name)
+        if step is None:
+            return
+        self.update(f"{self.label}...\n{step}, please wait...")
+
+    def update(self, text):
+        if text != self._last_text:
+            self._last_text = text
+            self.reporter.publish(self.chat_id, self.message_id, text)
+
+    def finish(self, text=None):
+        """Publish a final status (if given) and stop tracking the message."""
+        if text is not None:
+            self.update(text)
+        self.reporter.close(self.chat_id, self.message_id, flush=text is not None)
+
+
+class ProgressReporter:
+    """Coalesces progress updates per chat and applies them through throttled message edits.
+
+    Hooks only record the latest text for a message; a pool of sender
+    threads sends at most one edit per chat every chat_interval seconds, and
+    every edit takes a token from a global limiter so the bot stays under
+    its overall Telegram API budget. Each sender blocks on its HTTP request,
+    so throughput is also capped at senders / edit latency, whatever
+    global_rate is set to.
+    """
+
+    def __init__(self, edit_func, chat_interval=3.0, global_rate=10, burst=None, senders=4):
+        self.edit_func = edit_func
+        self.chat_interval = chat_interval
+        self.limiter = RateLimiter(global_rate, burst)
+        self.senders = senders
+        self._pending = OrderedDict()  # (chat_id, message_id) -> latest text
+        self._next_edit = {}  # chat_id -> monotonic time of the next allowed edit
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.senders):
+                thread = threading.Thread(target=self._run, name=f"progress-reporter-{i}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def track(self, chat_id, message_id, label):
+        return ProgressTracker(self, chat_id, message_id, label)
+
+    def publish(self, chat_id, message_id, text):
+        """Record the latest text for a message, replacing any update not yet sent."""
+        with self._cond:
+            key = (chat_id, message_id)
+            is_new = key not in self._pending
+            self._pending[key] = text
+            if is_new:
+                self._cond.notify()
+
+    def close(self, chat_id, message_id, flush=True):
+        """Stop tracking a message, sending its last update first if flush is set."""
+        with self._cond:
+            if not flush:
+                self._pending.pop((chat_id, message_id), None)
+
+    def _next_due(self):
+        """Return (key, delay) for the oldest update whose chat may be edited. Caller holds the lock."""
+        now = time.monotonic()
+        soonest = None
+        for key in self._pending:
+            due = self._next_edit.get(key[0], 0.0)
+            if due <= now:
+                return key, 0.0
+            if soonest is None or due < soonest:
+                soonest = due
+        return None, (None if soonest is None else soonest - now)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key, delay = self._next_due()
+                while key is None:
+                    self._cond.wait(delay)
+                    key, delay = self._next_due()
+                chat_id, message_id = key
+                # Claims the chat, so other senders leave it alone until the interval is over
+                self._next_edit[chat_id] = time.monotonic() + self.chat_interval
+                self._prune_chats()
+
+            self.limiter.acquire()
+            # Take the text only now, the limiter may have paused for a while
+            with self._cond:
+                text = self._pending.pop(key, None)
+            if text is None:
+                continue
+            try:
+                self.edit_func(text, chat_id, message_id)
+            except Exception as e:
+                if self._handle_error(e, chat_id):
+                    with self._cond:
+                        # Try again later, unless a newer text came in meanwhile
+                        self._pending.setdefault(key, text)
+                        self._cond.notify()
+
+    def _prune_chats(self):
+        """Forget per-chat timestamps that no longer matter. Caller holds the lock."""
+        if len(self._next_edit) > 1000:
+            now = time.monotonic()
+            self._next_edit = {chat: due for chat, due in self._next_edit.items() if due > now}
+
+    def _handle_error(self, e, chat_id):
+        """Log a failed edit. Returns True if it should be retried."""
+        description = str(e)
+        if 'message is not modified' in description:
+            return False
+        result = getattr(e, 'result_json', None) or {}
+        retry_after = (result.get('parameters') or {}).get('retry_after')
+        if getattr(e, 'error_code', None) == 429 and retry_after:
+            logging.warning("Telegram flood limit hit, pausing progress edits for %ss", retry_after)
+            self.limiter.pause(retry_after)
+            with self._cond:
+                self._next_edit[chat_id] = time.monotonic() + retry_after + self.chat_interval
+            return True
+        logging.error("Error editing progress message in chat %s: %s", chat_id, e)
+        return False
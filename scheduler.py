@@ -0,0 +1,331 @@
+import contextvars
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from logconfig import job_context
+
+# User tiers, from highest to lowest priority
+TIER_ADMIN = 'admin'
+TIER_VERIFIED = 'verified'
+TIER_FREE = 'free'
+
+TIER_RANK = {TIER_FREE: 0, TIER_VERIFIED: 1, TIER_ADMIN: 2}
+
+# A user with weight 4 gets four dispatches for every one of a weight 1 user
+DEFAULT_TIER_WEIGHTS = {TIER_ADMIN: 4, TIER_VERIFIED: 2, TIER_FREE: 1}
+
+# Maximum number of jobs a single user may have running at the same time
+DEFAULT_TIER_CONCURRENCY = {TIER_ADMIN: 2, TIER_VERIFIED: 2, TIER_FREE: 1}
+
+
+# The job the current worker thread is running
+_current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class QueueFullError(Exception):
+    """Raised when a job cannot be queued because the queue is full."""
+
+
+class DeferJob(Exception):
+    """Raised by a running job to give its worker back and run again after delay seconds."""
+
+    def __init__(self, delay, reason=None):
+        super().__init__(reason or f"Deferred for {delay}s")
+        self.delay = delay
+
+
+def current_job():
+    """Return the Job the calling thread is running, or None outside of a worker."""
+    return _current_job.get()
+
+
+class Job:
+    """A unit of work queued on behalf of a user."""
+
+    def __init__(self, job_id, user_id, tier, func, args, kwargs, on_shed=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.tier = tier
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_shed = on_shed
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.deferred_at = None  # When the job was first deferred
+        self.context = {}  # Scratch space the job keeps across deferred runs
+
+    def __repr__(self):
+        return f"<Job {self.id} user={self.user_id} tier={self.tier}>"
+
+
+class _UserQueue:
+    """Pending jobs and scheduling state for a single user."""
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.jobs = deque()
+        self.running = 0
+        self.pass_value = 0.0
+
+
+class JobScheduler:
+    """Fair-share, tier-aware scheduler in front of the download pipeline.
+
+    Every user gets their own queue. Workers pick the next job with stride
+    scheduling: each dispatch advances the user's pass by 1 / weight and the
+    user with the lowest pass goes next, so one user queueing twenty links
+    only gets their share of the workers while higher tiers get a larger one.
+    A job that can't make progress yet (e.g. no disk space) raises DeferJob
+    and goes back to the front of its user's queue after the delay, without
+    holding a worker in the meantime.
+    """
+
+    def __init__(self, workers=3, max_queue_length=50, tier_weights=None,
+                 tier_concurrency=None, default_job_duration=60.0):
+        self.workers = workers
+        self.max_queue_length = max_queue_length
+        self.tier_weights = dict(tier_weights or DEFAULT_TIER_WEIGHTS)
+        self.tier_concurrency = dict(tier_concurrency or DEFAULT_TIER_CONCURRENCY)
+        self.avg_job_duration = default_job_duration
+
+        self._users = {}
+        self._queued = 0
+        self._running = 0
+        self._deferred = 0
+        self._virtual_time = 0.0
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads."""
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"scheduler-{i}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, user_id, tier, func, *args, on_shed=None, **kwargs):
+        """Queue func(*args, **kwargs) for user_id and return the Job.
+
+        When the queue is full, the newest job of a lower-tier user is shed
+        to make room, or else that of the same-tier user with the most jobs
+        queued, so one user can't lock everyone else out. If neither
+        exists, QueueFullError is raised.
+        """
+        if tier not in self.tier_weights:
+            tier = TIER_FREE
+        with self._cond:
+            shed = None
+            if self._queued >= self.max_queue_length:
+                shed = self._shed_for(user_id, tier)
+                if shed is None:
+                    raise QueueFullError("The download queue is full")
+
+            job = Job(next(self._ids), user_id, tier, func, args, kwargs, on_shed)
+            user = self._users.get(user_id)
+            if user is None:
+                user = self._users[user_id] = _UserQueue(tier)
+            user.tier = tier
+            if not user.jobs and not user.running:
+                # Returning users start at the current virtual time so that
+                # idle periods don't turn into a burst of saved-up credit
+                user.pass_value = max(user.pass_value, self._virtual_time)
+            user.jobs.append(job)
+            self._queued += 1
+            self._cond.notify()
+
+        logging.debug("Queued job %s for user %s (tier %s)", job.id, user_id, tier)
+        if shed is not None:
+            self._notify_shed(shed)
+        return job
+
+    def position(self, job):
+        """Return the 1-based dispatch position of a queued job, or None if it is no longer queued."""
+        with self._cond:
+            user = self._users.get(job.user_id)
+            if user is None or job not in user.jobs:
+                return None
+            target_index = user.jobs.index(job)
+
+            # Replay the stride picks over the queued jobs until it is our turn
+            passes = {}
+            remaining = {}
+            for uid, other in self._users.items():
+                if other.jobs:
+                    passes[uid] = other.pass_value
+                    remaining[uid] = len(other.jobs)
+            taken = 0
+            picks = 0
+            while True:
+                uid = min(passes, key=passes.get)
+                picks += 1
+                if uid == job.user_id:
+                    if taken == target_index:
+                        return picks
+                    taken += 1
+                passes[uid] += 1.0 / self.tier_weights[self._users[uid].tier]
+                remaining[uid] -= 1
+                if not remaining[uid]:
+                    del passes[uid]
+
+    def estimated_wait(self, job):
+        """Return the estimated number of seconds until job starts."""
+        position = self.position(job)
+        if position is None:
+            return 0.0
+        with self._cond:
+            user = self._users.get(job.user_id)
+            if user is None or job not in user.jobs:
+                # Dispatched in the meantime
+                return 0.0
+            own_ahead = user.jobs.index(job) + user.running
+            cap = self.tier_concurrency[user.tier]
+            free_slots = self.workers - self._running
+            duration = self.avg_job_duration
+
+        if position <= free_slots and own_ahead < cap:
+            return 0.0
+        # Jobs ahead of us across all users, spread over the workers
+        global_wait = math.ceil(max(position - free_slots, 0) / self.workers) * duration
+        # Our own earlier jobs, limited by the per-user concurrency cap
+        own_wait = (own_ahead // cap) * duration
+        return max(global_wait, own_wait)
+
+    def is_idle(self):
+        """Return True when nothing is queued or deferred and at least one worker is free."""
+        with self._cond:
+            return self._queued == 0 and self._deferred == 0 and self._running < self.workers
+
+    def stats(self):
+        """Return a snapshot of queue counters."""
+        with self._cond:
+            return {
+                'queued': self._queued,
+                'running': self._running,
+                'deferred': self._deferred,
+                'workers': self.workers,
+                'users': sum(1 for u in self._users.values() if u.jobs or u.running),
+                'avg_job_duration': self.avg_job_duration,
+            }
+
+    def _shed_for(self, user_id, tier):
+        """Drop the newest job of the lowest-tier user below tier, or else of the
+        same-tier user queueing the most jobs, more than user_id would have after
+        submitting. Caller holds the lock."""
+        own = self._users.get(user_id)
+        own_queued = len(own.jobs) + 1 if own is not None else 1
+        victim = None
+        for uid, user in self._users.items():
+            if not user.jobs or uid == user_id or TIER_RANK[user.tier] > TIER_RANK[tier]:
+                continue
+            if user.tier == tier and len(user.jobs) <= own_queued:
+                continue
+            if (victim is None
+                    or TIER_RANK[user.tier] < TIER_RANK[victim.tier]
+                    or (user.tier == victim.tier and len(user.jobs) > len(victim.jobs))):
+                victim = user
+        if victim is None:
+            return None
+        self._queued -= 1
+        job = victim.jobs.pop()
+        if not victim.jobs and not victim.running:
+            del self._users[job.user_id]
+        return job
+
+    def _notify_shed(self, job):
+        logging.warning("Shed job %s of user %s (tier %s) to make room", job.id, job.user_id, job.tier)
+        if job.on_shed is not None:
+            try:
+                job.on_shed(job)
+            except Exception as e:
+                logging.error("Error in shed callback for job %s: %s", job.id, e)
+
+    def _next_job(self):
+        """Pick the next runnable job by lowest pass. Caller holds the lock."""
+        best = None
+        for uid, user in self._users.items():
+            if not user.jobs or user.running >= self.tier_concurrency[user.tier]:
+                continue
+            if best is None or user.pass_value < best[1].pass_value:
+                best = (uid, user)
+        if best is None:
+            return None
+        uid, user = best
+        job = user.jobs.popleft()
+        self._virtual_time = user.pass_value
+        user.pass_value += 1.0 / self.tier_weights[user.tier]
+        user.running += 1
+        self._queued -= 1
+        self._running += 1
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+
+            job.started_at = time.monotonic()
+            logging.debug("Starting job %s for user %s after %.1fs in queue",
+                          job.id, job.user_id, job.started_at - job.enqueued_at)
+            deferred = None
+            token = _current_job.set(job)
+            try:
+                with job_context(f"job-{job.id}"):
+                    job.func(*job.args, **job.kwargs)
+            except DeferJob as e:
+                deferred = e
+            except Exception as e:
+                logging.error("Job %s failed: %s", job.id, e, exc_info=True)
+            finally:
+                _current_job.reset(token)
+                job.finished_at = time.monotonic()
+                self._finish(job, deferred)
+
+    def _finish(self, job, deferred=None):
+        with self._cond:
+            user = self._users[job.user_id]
+            user.running -= 1
+            self._running -= 1
+            if deferred is not None:
+                logging.info("Deferring job %s for %ss: %s", job.id, deferred.delay, deferred)
+                if job.deferred_at is None:
+                    job.deferred_at = job.finished_at
+                self._deferred += 1
+                timer = threading.Timer(deferred.delay, self._requeue, (job,))
+                timer.daemon = True
+                timer.start()
+            else:
+                # Exponential moving average of how long a job takes
+                duration = job.finished_at - job.started_at
+                self.avg_job_duration = 0.8 * self.avg_job_duration + 0.2 * duration
+            if not user.jobs and not user.running:
+                # submit() starts a returning user at the current virtual time anyway
+                del self._users[job.user_id]
+            # A slot opened up, possibly for a user that was at its cap
+            self._cond.notify_all()
+
+    def _requeue(self, job):
+        """Put a deferred job back at the front of its user's queue. It was admitted
+        before, so the queue length limit doesn't apply."""
+        with self._cond:
+            self._deferred -= 1
+            user = self._users.get(job.user_id)
+            if user is None:
+                user = self._users[job.user_id] = _UserQueue(job.tier)
+            if not user.jobs and not user.running:
+                user.pass_value = max(user.pass_value, self._virtual_time)
+            user.jobs.appendleft(job)
+            self._queued += 1
+            self._cond.notify()
@@ -0,0 +1,299 @@
+import itertools
+import logging
+import os
+import shutil
+import threading
+import time
+
+# Used when yt-dlp reports neither a size nor a bitrate for the selected formats
+DEFAULT_ESTIMATE_BYTES = 200 * 1024 * 1024
+
+# Merging video and audio keeps both streams on disk next to the merged output
+MERGE_PEAK_FACTOR = 2.0
+
+
+class StorageFullError(Exception):
+    """Raised when a download cannot get a disk reservation.
+
+    retryable is False when waiting would not help, e.g. the download is
+    larger than the whole budget.
+    """
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _format_bytes(info_or_format):
+    size = info_or_format.get('filesize') or info_or_format.get('filesize_approx')
+    if size:
+        return size
+    tbr = info_or_format.get('tbr')
+    duration = info_or_format.get('duration')
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+
+def estimate_download_bytes(info, extract_audio=False):
+    """Estimate (final size, peak disk usage) of downloading an extracted (download=False) info dict."""
+    requested = info.get('requested_formats')
+    if requested:
+        size = 0
+        for f in requested:
+            format_size = _format_bytes(dict(f, duration=info.get('duration')))
+            if format_size is None:
+                return DEFAULT_ESTIMATE_BYTES, int(DEFAULT_ESTIMATE_BYTES * MERGE_PEAK_FACTOR)
+            size += format_size
+        return size, int(size * MERGE_PEAK_FACTOR)
+
+    size = _format_bytes(info) or DEFAULT_ESTIMATE_BYTES
+    if extract_audio:
+        # The source audio stays around until the MP3 has been written
+        mp3_size = int(192 * 1000 / 8 * (info.get('duration') or 0)) or size
+        return mp3_size, size + mp3_size
+    return size, size
+
+
+class Reservation:
+    """Disk space set aside for one download.
+
+    written_bytes is what the download has put on disk so far; that part
+    already shows up in the free space, so only the rest of the
+    reservation is held back.
+    """
+
+    def __init__(self, manager, reservation_id, expected_bytes, reserved_bytes):
+        self.manager = manager
+        self.id = reservation_id
+        self.expected_bytes = expected_bytes
+        self.reserved_bytes = reserved_bytes
+        self.written_bytes = 0
+        self.actual_bytes = None
+        self._written = {}  # file name -> bytes, merged formats download several files
+
+    def progress_hook(self, d):
+        """yt-dlp progress hook that keeps written_bytes up to date."""
+        self._written[d.get('filename')] = d.get('downloaded_bytes') or d.get('total_bytes') or 0
+        self.written_bytes = sum(self._written.values())
+
+    def outstanding_bytes(self):
+        """Reserved bytes the download has not written yet."""
+        return max(self.reserved_bytes - self.written_bytes, 0)
+
+    def record_actual(self, actual_bytes):
+        """Record how many bytes the download actually produced."""
+        self.actual_bytes = actual_bytes
+
+    def release(self):
+        self.manager._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class _Deliverable:
+    def __init__(self, path, size, expires_at, on_evict):
+        self.path = path
+        self.size = size
+        self.created_at = time.monotonic()
+        self.expires_at = expires_at
+        self.on_evict = on_evict
+
+
+class StorageManager:
+    """Disk-budget admission control for the download directory.
+
+    Each download reserves its expected size before it starts. Reservations
+    that don't fit wait for space to be freed, up to a timeout, and are then
+    rejected. Against the budget, every file under root counts for as long
+    as it is on disk, also after its reservation is released, plus what
+    reservations have not written yet and the registered caches. Finished
+    files that are kept for the user are tracked as deliverables with an
+    expiry; under pressure expired ones are removed at once, then
+    registered caches are shrunk and, if that is not enough, the oldest
+    deliverables past min_retention are removed too.
+    """
+
+    def __init__(self, root, budget_bytes=None, min_free_bytes=1024 * 1024 * 1024,
+                 min_retention=600, sweep_interval=60):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.min_free_bytes = min_free_bytes
+        self.min_retention = min_retention
+        self.sweep_interval = sweep_interval
+        # Moving average of actual / expected size, used to correct estimates
+        self.estimate_ratio = 1.0
+
+        self._reservations = {}
+        self._deliverables = {}
+        self._caches = []
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Start the thread that deletes expired deliverables."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sweep_loop, name="storage-sweeper", daemon=True)
+                self._thread.start()
+
+    def add_cache(self, cache):
+        """Count a cache on the same disk against the budget. It must have size()
+        and shrink(needed_bytes), which evicts entries and returns the bytes freed."""
+        with self._cond:
+            self._caches.append(cache)
+
+    def reserve(self, expected_bytes, peak_bytes=None, timeout=300, shrink_caches=True):
+        """Reserve space for a download, waiting up to timeout seconds for it to free up.
+
+        expected_bytes is the estimated size of the finished file and
+        peak_bytes the most the download will use at once (e.g. while merging).
+        With shrink_caches=False registered caches are left alone, e.g. when
+        the download is meant to fill a cache itself.
+        """
+        # Scale up by how much earlier downloads outgrew their estimate
+        scale = max(self.estimate_ratio, 1.0)
+        reserved_bytes = int(max(peak_bytes or 0, expected_bytes) * scale)
+        if self.budget_bytes is not None and reserved_bytes > self.budget_bytes:
+            raise StorageFullError(f"Download needs {reserved_bytes} bytes, more than the {self.budget_bytes} byte budget",
+                                   retryable=False)
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._headroom() < reserved_bytes:
+                if self._evict_for(reserved_bytes - self._headroom(), shrink_caches):
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise StorageFullError(f"No disk space for a {reserved_bytes} byte download")
+                logging.info("Waiting for %d bytes of disk space", reserved_bytes)
+                self._cond.wait(min(remaining, self.sweep_interval))
+
+            reservation = Reservation(self, next(self._ids), expected_bytes, reserved_bytes)
+            self._reservations[reservation.id] = reservation
+        logging.debug("Reserved %d bytes (reservation %s)", reserved_bytes, reservation.id)
+        return reservation
+
+    def add_deliverable(self, path, ttl=1800, on_evict=None):
+        """Keep path on disk for ttl seconds, then delete it and call on_evict(path, early)."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        with self._cond:
+            self._deliverables[path] = _Deliverable(path, size, time.monotonic() + ttl, on_evict)
+
+    def remove_file(self, path):
+        """Delete a file we no longer need and wake up waiting reservations."""
+        with self._cond:
+            self._deliverables.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'reserved_bytes': sum(r.reserved_bytes for r in self._reservations.values()),
+                'written_bytes': sum(r.written_bytes for r in self._reservations.values()),
+                'deliverable_bytes': sum(d.size for d in self._deliverables.values()),
+                'cache_bytes': sum(cache.size() for cache in self._caches),
+                'reservations': len(self._reservations),
+                'deliverables': len(self._deliverables),
+                'disk_used_bytes': self._disk_used(),
+                'headroom_bytes': self._headroom(),
+                'estimate_ratio': self.estimate_ratio,
+            }
+
+    def _headroom(self):
+        """Bytes that can still be reserved. Caller holds the lock."""
+        # Bytes already written are on disk (and under root), don't subtract them twice
+        outstanding = sum(r.outstanding_bytes() for r in self._reservations.values())
+        free = shutil.disk_usage(self.root).free - self.min_free_bytes - outstanding
+        if self.budget_bytes is None:
+            return free
+        used = self._disk_used() + sum(cache.size() for cache in self._caches)
+        return min(free, self.budget_bytes - used - outstanding)
+
+    def _disk_used(self):
+        """Bytes of all files under root: downloads in progress, files waiting
+        to be uploaded and deliverables alike. Caller holds the lock."""
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass  # Deleted in the meantime
+        return total
+
+    def _release(self, reservation):
+        with self._cond:
+            if self._reservations.pop(reservation.id, None) is None:
+                return
+            self._cond.notify_all()
+        if reservation.actual_bytes:
+            ratio = reservation.actual_bytes / max(reservation.expected_bytes, 1)
+            self.estimate_ratio = 0.9 * self.estimate_ratio + 0.1 * ratio
+            if reservation.actual_bytes > reservation.reserved_bytes:
+                logging.warning("Download %s used %d bytes, %d more than reserved",
+                                reservation.id, reservation.actual_bytes,
+                                reservation.actual_bytes - reservation.reserved_bytes)
+
+    def _evict_for(self, needed, shrink_caches=True):
+        """Free needed bytes: expired deliverables first, then cache entries,
+        then the oldest deliverables past min_retention.
+
+        Caller holds the lock. Returns the number of bytes freed.
+        """
+        now = time.monotonic()
+        expired = sorted((d for d in self._deliverables.values() if d.expires_at <= now),
+                         key=lambda d: d.expires_at)
+        retained = sorted((d for d in self._deliverables.values()
+                           if d.expires_at > now and now - d.created_at >= self.min_retention),
+                          key=lambda d: d.created_at)
+        freed = 0
+        for deliverable in expired:
+            if freed >= needed:
+                return freed
+            freed += self._evict(deliverable)
+        if shrink_caches:
+            for cache in self._caches:
+                if freed >= needed:
+                    return freed
+                freed += cache.shrink(needed - freed)
+        for deliverable in retained:
+            if freed >= needed:
+                break
+            freed += self._evict(deliverable, early=True)
+        return freed
+
+    def _evict(self, deliverable, early=False):
+        """Delete a deliverable. Caller holds the lock."""
+        self._deliverables.pop(deliverable.path, None)
+        try:
+            if os.path.exists(deliverable.path):
+                os.remove(deliverable.path)
+                logging.debug("Deleted file: %s", deliverable.path)
+        except OSError as e:
+            logging.error("Error deleting file: %s, Error: %s", deliverable.path, e)
+            return 0
+        if deliverable.on_evict is not None:
+            # Notify outside of the lock, callbacks may talk to Telegram
+            threading.Thread(target=deliverable.on_evict, args=(deliverable.path, early), daemon=True).start()
+        return deliverable.size
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            with self._cond:
+                now = time.monotonic()
+                for deliverable in [d for d in self._deliverables.values() if d.expires_at <= now]:
+                    self._evict(deliverable)
+                self._cond.notify_all()
@@ -0,0 +1,65 @@
+import os
+
+from prefetch import DownloadCache, Prefetcher, PopularityTracker
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+def add_entry(cache, key, size):
+    path = os.path.join(cache.root, '_'.join(key))
+    write_file(path, size)
+    cache.add(key, path, os.path.basename(path))
+    return path
+
+
+def test_cache_only_touches_its_own_directory(tmp_path):
+    foreign = tmp_path / 'cookies.txt'
+    foreign.write_text('keep me')
+
+    cache = DownloadCache(str(tmp_path), max_bytes=1000)
+    write_file(os.path.join(cache.root, 'leftover.part'), 10)
+    DownloadCache(str(tmp_path), max_bytes=1000)
+
+    assert foreign.read_text() == 'keep me'
+    assert os.listdir(cache.root) == []
+
+
+def test_make_room_keeps_hot_entries(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=3000)
+    hot = ('youtube', 'a', '22')
+    add_entry(cache, hot, 1000)
+    add_entry(cache, ('youtube', 'b', '22'), 1000)
+
+    assert not cache.make_room(2500, keep={hot, ('youtube', 'b', '22')})
+    assert cache.make_room(2000, keep={hot})
+    assert hot in cache
+    assert cache.size() == 1000
+
+
+def test_shrink_evicts_least_recently_used(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=3000)
+    old = ('youtube', 'a', '22')
+    add_entry(cache, old, 1000)
+    add_entry(cache, ('youtube', 'b', '22'), 1000)
+    cache.checkout(('youtube', 'b', '22'), str(tmp_path))
+
+    assert cache.shrink(500) == 1000
+    assert old not in cache
+
+
+def test_failed_prefetch_leaves_no_partial_files(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=3000)
+    kept = add_entry(cache, ('youtube', 'a', '22'), 100)
+    tracker = PopularityTracker(threshold=1)
+    tracker.record_format('youtube', 'b', '22')
+
+    def fetch(key, ratelimit, progress_hook, make_room):
+        write_file(os.path.join(cache.root, 'video.f22.mp4.part'), 100)
+        raise RuntimeError("connection reset")
+
+    Prefetcher(tracker, cache, fetch, is_idle=lambda: True).run_once()
+
+    assert os.listdir(cache.root) == [os.path.basename(kept)]
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from progress import ProgressReporter, RateLimiter
+
+
+class FloodError(Exception):
+    """Looks like telebot's ApiTelegramException for a 429."""
+
+    def __init__(self, retry_after):
+        super().__init__("Too Many Requests")
+        self.error_code = 429
+        self.result_json = {'parameters': {'retry_after': retry_after}}
+
+
+class FakeChat:
+    def __init__(self, failures=0, on_failure=None):
+        self.failures = failures
+        self.on_failure = on_failure
+        self.edits = []
+        self.done = threading.Event()
+
+    def edit(self, text, chat_id, message_id):
+        if self.failures:
+            self.failures -= 1
+            if self.on_failure is not None:
+                self.on_failure()
+            raise FloodError(0.2)
+        self.edits.append(text)
+        self.done.set()
+
+
+def make_reporter(chat):
+    return ProgressReporter(chat.edit, chat_interval=0.05, global_rate=100, senders=2)
+
+
+def test_rate_limiter_below_one_per_second_hands_out_a_token():
+    limiter = RateLimiter(0.5)
+    started = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started < 0.1
+
+
+def test_updates_are_coalesced():
+    chat = FakeChat()
+    reporter = make_reporter(chat)
+    for text in ("10%", "20%", "30%"):
+        reporter.publish(1, 1, text)
+    reporter.start()
+
+    assert chat.done.wait(2)
+    time.sleep(0.2)
+    assert chat.edits == ["30%"]
+
+
+def test_final_text_is_retried_after_flood_limit():
+    chat = FakeChat(failures=1)
+    reporter = make_reporter(chat)
+    reporter.start()
+    reporter.publish(1, 1, "Download complete")
+
+    assert chat.done.wait(2)
+    assert chat.edits == ["Download complete"]
+
+
+def test_retry_keeps_newer_text():
+    reporter = None
+
+    def publish_newer():
+        reporter.publish(1, 1, "newer")
+
+    chat = FakeChat(failures=1, on_failure=publish_newer)
+    reporter = make_reporter(chat)
+    reporter.start()
+    reporter.publish(1, 1, "older")
+
+    assert chat.done.wait(2)
+    time.sleep(0.2)
+    assert chat.edits == ["newer"]
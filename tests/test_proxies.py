@@ -0,0 +1,233 @@
+import http.server
+import io
+import socket
+import sys
+import threading
+import time
+
+import pytest
+from yt_dlp import YoutubeDL
+from yt_dlp.networking import Response
+from yt_dlp.networking.exceptions import HTTPError, ProxyError, TransportError
+from yt_dlp.utils import DownloadError, ExtractorError, GeoRestrictedError
+
+from proxies import NoProxyAvailable, Proxy, ProxyPool, is_proxy_error
+
+VIDEO_URL = 'http://video.test/watch'
+
+
+class StandInProxy:
+    """Local HTTP proxy that answers every request itself with a fixed status."""
+
+    def __init__(self, status=200, delay=0.0):
+        self.status = status
+        self.delay = delay
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        proxy = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                with proxy._lock:
+                    proxy.requests += 1
+                    proxy.in_flight += 1
+                    proxy.max_in_flight = max(proxy.max_in_flight, proxy.in_flight)
+                time.sleep(proxy.delay)
+                body = b'ok'
+                self.send_response(proxy.status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with proxy._lock:
+                    proxy.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def stand_ins():
+    proxies = []
+
+    def make(*args, **kwargs):
+        proxy = StandInProxy(*args, **kwargs)
+        proxies.append(proxy)
+        return proxy
+
+    yield make
+    for proxy in proxies:
+        proxy.close()
+
+
+def dead_proxy_url():
+    """A local address nothing listens on."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f'http://127.0.0.1:{port}'
+
+
+def fetch(lease):
+    with YoutubeDL({'proxy': lease.url, 'quiet': True, 'socket_timeout': 2}) as ydl:
+        return ydl.urlopen(VIDEO_URL).read()
+
+
+def test_failed_proxy_is_retried_on_another(stand_ins):
+    blocked = stand_ins(status=403)
+    healthy = stand_ins()
+    pool = ProxyPool([Proxy(blocked.url), Proxy(healthy.url)])
+
+    assert pool.run('youtube', fetch, should_retry=is_proxy_error) == b'ok'
+
+    assert blocked.requests == 1 and healthy.requests == 1
+    stats = pool.stats()
+    assert stats[blocked.url]['health']['youtube']['failures'] == 1
+    assert stats[healthy.url]['health']['youtube']['successes'] == 1
+
+
+def test_unreachable_proxy_is_retried_on_another(stand_ins):
+    healthy = stand_ins()
+    pool = ProxyPool([Proxy(dead_proxy_url()), Proxy(healthy.url)])
+
+    assert pool.run('youtube', fetch, should_retry=is_proxy_error) == b'ok'
+
+
+def test_non_proxy_errors_are_not_retried(stand_ins):
+    missing = stand_ins(status=404)
+    other = stand_ins()
+    pool = ProxyPool([Proxy(missing.url), Proxy(other.url)])
+
+    with pytest.raises(HTTPError):
+        pool.run('youtube', fetch, should_retry=is_proxy_error)
+
+    assert other.requests == 0
+    assert pool.stats()[missing.url]['health']['youtube']['score'] == 1.0
+
+
+def test_unhealthy_proxy_cools_down_and_gets_another_chance(stand_ins):
+    blocked = stand_ins(status=429)
+    clock = FakeClock()
+    pool = ProxyPool([Proxy(blocked.url)], cooldown=60, clock=clock)
+
+    # 1.0 -> 0.7 -> 0.49 -> 0.34 -> 0.24, below the 0.3 threshold
+    for _ in range(4):
+        with pytest.raises(HTTPError):
+            pool.run('youtube', fetch, attempts=1, should_retry=is_proxy_error)
+    health = pool.stats()[blocked.url]['health']['youtube']
+    assert health['cooling']
+    assert health['score'] < 0.3
+
+    clock.now += 61
+    health = pool.stats()[blocked.url]['health']['youtube']
+    assert not health['cooling']
+    # stats() doesn't reset the score, the next pick does
+    pool.release(pool.acquire('youtube'))
+    assert pool.stats()[blocked.url]['health']['youtube']['score'] == 0.5
+
+
+def test_cooling_proxy_is_ranked_last():
+    clock = FakeClock()
+    pool = ProxyPool([Proxy('http://a.test:1'), Proxy('http://b.test:1')], clock=clock)
+    first = pool.proxies[0]
+    for _ in range(4):
+        pool.release(pool.acquire('tiktok', exclude=[pool.proxies[1].url]), ok=False)
+
+    assert pool.acquire('tiktok').proxy is pool.proxies[1]
+    # Health is per source, YouTube still prefers the first proxy
+    assert pool.acquire('youtube').proxy is first
+
+
+def test_per_proxy_concurrency_limit(stand_ins):
+    slow = stand_ins(delay=0.2)
+    pool = ProxyPool([Proxy(slow.url, max_concurrency=2)])
+
+    threads = [threading.Thread(target=pool.run, args=('youtube', fetch)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert slow.requests == 5
+    assert slow.max_in_flight == 2
+
+
+def test_acquire_gives_up_when_all_slots_are_busy():
+    pool = ProxyPool([Proxy('http://a.test:1', max_concurrency=1)])
+    lease = pool.acquire('youtube')
+
+    with pytest.raises(NoProxyAvailable):
+        pool.acquire('youtube', timeout=0.1)
+
+    pool.release(lease)
+    pool.release(pool.acquire('youtube', timeout=0.1))
+
+
+def test_routes_limit_the_candidates():
+    pool = ProxyPool([Proxy('http://a.test:1'), Proxy('http://b.test:1')],
+                     routes={'tiktok': ['http://b.test:1']})
+
+    assert [p.url for p in pool.candidates('tiktok')] == ['http://b.test:1']
+    assert len(pool.candidates('youtube')) == 2
+
+
+def test_probe_scores_every_routed_proxy(stand_ins):
+    healthy = stand_ins()
+    blocked = stand_ins(status=403)
+    dead = dead_proxy_url()
+    pool = ProxyPool([Proxy(healthy.url), Proxy(blocked.url), Proxy(dead)])
+
+    results = pool.probe('youtube', VIDEO_URL, timeout=2)
+
+    assert results == {healthy.url: True, blocked.url: False, dead: False}
+    stats = pool.stats()
+    assert stats[healthy.url]['health']['youtube']['latency'] is not None
+    assert stats[blocked.url]['health']['youtube']['failures'] == 1
+
+
+def download_error(error):
+    try:
+        raise error
+    except Exception:
+        return DownloadError(str(error), sys.exc_info())
+
+
+def http_error(status):
+    return HTTPError(Response(io.BytesIO(b''), VIDEO_URL, {}, status=status))
+
+
+@pytest.mark.parametrize('error, expected', [
+    (ExtractorError('Private video', expected=True), False),
+    (ExtractorError('Requested format is not available', expected=True), False),
+    (ExtractorError('Unable to download webpage', cause=http_error(404)), False),
+    (http_error(404), False),
+    (GeoRestrictedError('The uploader has not made this video available in your country'), True),
+    (ExtractorError("Sign in to confirm you're not a bot", expected=True), True),
+    (http_error(403), True),
+    (http_error(429), True),
+    (ProxyError('Tunnel connection failed'), True),
+    (ExtractorError('Unable to download webpage', cause=TransportError('Connection reset')), True),
+])
+def test_is_proxy_error(error, expected):
+    assert is_proxy_error(download_error(error)) is expected
+
+
+def test_download_error_without_cause_is_not_a_proxy_error():
+    assert not is_proxy_error(DownloadError('ERROR: something went wrong'))
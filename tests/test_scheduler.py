@@ -0,0 +1,156 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import DeferJob, JobScheduler, QueueFullError, TIER_ADMIN, TIER_FREE, TIER_VERIFIED
+
+# Enough concurrency that only the stride order decides who goes next
+UNCAPPED = {TIER_ADMIN: 100, TIER_VERIFIED: 100, TIER_FREE: 100}
+
+
+def noop():
+    pass
+
+
+def dispatch(scheduler, count):
+    """Pick count jobs the way a worker would, without running them."""
+    with scheduler._cond:
+        return [scheduler._next_job() for _ in range(count)]
+
+
+def finish(scheduler, job):
+    job.started_at = job.finished_at = time.monotonic()
+    scheduler._finish(job)
+
+
+def test_stride_order_follows_tier_weights():
+    scheduler = JobScheduler(tier_concurrency=UNCAPPED)
+    for _ in range(10):
+        scheduler.submit('admin', TIER_ADMIN, noop)
+        scheduler.submit('free', TIER_FREE, noop)
+
+    picked = [job.user_id for job in dispatch(scheduler, 10)]
+
+    assert picked.count('admin') == 8
+    assert picked.count('free') == 2
+
+
+def test_users_of_the_same_tier_alternate():
+    scheduler = JobScheduler(tier_concurrency=UNCAPPED)
+    for _ in range(3):
+        scheduler.submit(1, TIER_FREE, noop)
+    scheduler.submit(2, TIER_FREE, noop)
+
+    picked = [job.user_id for job in dispatch(scheduler, 4)]
+
+    assert picked == [1, 2, 1, 1]
+
+
+def test_per_user_concurrency_cap():
+    scheduler = JobScheduler()
+    scheduler.submit(1, TIER_FREE, noop)
+    scheduler.submit(1, TIER_FREE, noop)
+
+    first, second = dispatch(scheduler, 2)
+
+    assert first is not None
+    assert second is None
+    finish(scheduler, first)
+    assert dispatch(scheduler, 1)[0] is not None
+
+
+def test_position_replays_stride_order():
+    scheduler = JobScheduler(tier_concurrency=UNCAPPED)
+    jobs = [scheduler.submit(1, TIER_FREE, noop) for _ in range(3)]
+    other = scheduler.submit(2, TIER_FREE, noop)
+
+    assert [scheduler.position(job) for job in jobs] == [1, 3, 4]
+    assert scheduler.position(other) == 2
+
+
+def test_full_queue_sheds_lower_tier_first():
+    shed = []
+    scheduler = JobScheduler(max_queue_length=2)
+    scheduler.submit(1, TIER_FREE, noop, on_shed=shed.append)
+    scheduler.submit(2, TIER_VERIFIED, noop, on_shed=shed.append)
+
+    scheduler.submit(3, TIER_ADMIN, noop)
+
+    assert [job.user_id for job in shed] == [1]
+    assert 1 not in scheduler._users
+
+
+def test_full_queue_sheds_same_tier_hog():
+    shed = []
+    scheduler = JobScheduler(max_queue_length=5)
+    for _ in range(5):
+        scheduler.submit(1, TIER_FREE, noop, on_shed=shed.append)
+
+    scheduler.submit(2, TIER_FREE, noop)
+
+    assert len(shed) == 1 and shed[0].user_id == 1
+    assert len(scheduler._users[1].jobs) == 4
+    with pytest.raises(QueueFullError):
+        scheduler.submit(1, TIER_FREE, noop)
+
+
+def test_full_queue_rejects_when_nobody_has_more_jobs():
+    scheduler = JobScheduler(max_queue_length=2)
+    scheduler.submit(1, TIER_FREE, noop)
+    scheduler.submit(2, TIER_FREE, noop)
+
+    with pytest.raises(QueueFullError):
+        scheduler.submit(3, TIER_FREE, noop)
+
+
+def test_estimated_wait():
+    scheduler = JobScheduler(workers=1, default_job_duration=10.0)
+    jobs = [scheduler.submit(1, TIER_FREE, noop) for _ in range(3)]
+
+    assert scheduler.estimated_wait(jobs[0]) == 0.0
+    assert scheduler.estimated_wait(jobs[1]) == 10.0
+    assert scheduler.estimated_wait(jobs[2]) == 20.0
+
+
+def test_estimated_wait_of_dispatched_job_is_zero():
+    scheduler = JobScheduler()
+    job = scheduler.submit(1, TIER_FREE, noop)
+    dispatch(scheduler, 1)
+
+    assert scheduler.estimated_wait(job) == 0.0
+
+
+def test_idle_users_are_dropped():
+    scheduler = JobScheduler(workers=2)
+    for user_id in range(200):
+        scheduler.submit(user_id, TIER_FREE, noop)
+        finish(scheduler, dispatch(scheduler, 1)[0])
+
+    assert scheduler._users == {}
+    assert scheduler.stats()['users'] == 0
+
+
+def test_deferred_job_gives_its_worker_back_and_runs_again():
+    scheduler = JobScheduler(workers=1)
+    runs = []
+    other_ran = threading.Event()
+    done = threading.Event()
+
+    def defer_once():
+        runs.append(time.monotonic())
+        if len(runs) == 1:
+            raise DeferJob(0.2)
+        done.set()
+
+    scheduler.submit(1, TIER_FREE, defer_once)
+    scheduler.submit(2, TIER_FREE, other_ran.set)
+    scheduler.start()
+
+    # The other user's job gets the only worker while the first one waits
+    assert other_ran.wait(1)
+    assert not done.is_set()
+    assert not scheduler.is_idle()
+    assert done.wait(2)
+    assert len(runs) == 2
+    assert runs[1] - runs[0] >= 0.2
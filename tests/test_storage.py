@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from storage import StorageFullError, StorageManager
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return StorageManager(str(tmp_path), budget_bytes=10000, min_free_bytes=0)
+
+
+def test_released_file_still_counts_until_removed(manager, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    with manager.reserve(4000, timeout=0) as reservation:
+        write_file(path, 4000)
+        reservation.record_actual(4000)
+
+    # Downloaded, not uploaded yet
+    assert manager.stats()['headroom_bytes'] == 6000
+
+    manager.remove_file(path)
+    assert manager.stats()['headroom_bytes'] == 10000
+
+
+def test_renamed_file_still_counts(manager, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    with manager.reserve(4000, timeout=0):
+        write_file(path, 4000)
+    os.rename(path, str(tmp_path / 'video_1.mp4'))
+
+    assert manager.stats()['headroom_bytes'] == 6000
+
+
+def test_written_bytes_are_not_counted_twice(manager, tmp_path):
+    reservation = manager.reserve(6000, timeout=0)
+    write_file(str(tmp_path / 'video.f137.mp4.part'), 4000)
+    reservation.progress_hook({'filename': 'video.f137.mp4', 'downloaded_bytes': 4000})
+
+    # 4000 on disk plus the 2000 the download has yet to write
+    assert manager.stats()['headroom_bytes'] == 4000
+    reservation.release()
+
+
+def test_reservation_that_does_not_fit_is_rejected(manager):
+    held = manager.reserve(8000, timeout=0)
+    with pytest.raises(StorageFullError) as excinfo:
+        manager.reserve(4000, timeout=0)
+    assert excinfo.value.retryable
+    held.release()
+    manager.reserve(4000, timeout=0).release()
+
+
+def test_larger_than_budget_is_not_retryable(manager):
+    with pytest.raises(StorageFullError) as excinfo:
+        manager.reserve(20000, timeout=0)
+    assert not excinfo.value.retryable
+
+
+def test_expired_deliverables_are_evicted_for_new_reservations(manager, tmp_path):
+    path = str(tmp_path / 'big.mp4')
+    write_file(path, 8000)
+    manager.add_deliverable(path, ttl=0)
+
+    manager.reserve(4000, timeout=0).release()
+
+    assert not os.path.exists(path)
@@ -1,28 +1,38 @@
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from yt_dlp import YoutubeDL
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaVideo
 import os
 import requests
 import json
 import logging
 import urllib.parse
+import hmac
 import threading
 import time
 from dotenv import load_dotenv
-from database import connect_db, ensure_user_in_db, create_user_downloads_table, get_download_count, increment_download_count, reset_database
+from database import connect_db, ensure_user_in_db, create_user_downloads_table, get_download_count, increment_download_count, reserve_download_count, refund_download_count, reset_database
 from requests.exceptions import ConnectionError, SSLError
 import re
 from flask import Flask, jsonify, request, send_from_directory
 from datetime import datetime
+from batch import Batch, expand_links, find_links, is_playlist_url, write_archive
+from logconfig import configure_logging
+from prefetch import DownloadCache, Prefetcher, PopularityTracker
+from proxies import NoProxyAvailable, PooledYoutubeDL, ProxyPool, source_for_url
+from progress import ProgressReporter
+from scheduler import DeferJob, JobScheduler, QueueFullError, TIER_ADMIN, TIER_VERIFIED, TIER_FREE, current_job
+from storage import StorageManager, StorageFullError, estimate_download_bytes
 
-# Set up basic logging
-logging.basicConfig(level=logging.DEBUG)
+# Load environment variables
+load_dotenv()
+
+# Set up logging (LOG_LEVEL, LOG_FORMAT=json, LOG_SAMPLE_RATE, LOG_QUEUE_SIZE)
+configure_logging()
 
 # List of user IDs that can bypass verification
 admin_user_ids = [7951420571, 987654321]  # Replace with actual user IDs
 
-# Load environment variables
-load_dotenv()
+# Users who passed verification get priority over free-tier traffic in the download queue
+verified_user_ids = {int(uid) for uid in os.getenv("VERIFIED_USER_IDS", "").split(",") if uid.strip()}
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024  # 50 MB
 DOWNLOAD_PATH = "/app/downloads/"
@@ -35,20 +45,214 @@ bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 # Path to your cookies file in Railway project
 COOKIES_PATH = "/app/cookies.txt"
 
+# yt-dlp's verbose output is large, only turn it on when debugging extraction problems
+YTDLP_VERBOSE = os.getenv("YTDLP_VERBOSE", "").lower() in ("1", "true", "yes")
+
 # Initialize Flask
 app = Flask(__name__)
 
-def delete_file_after_delay(file_path, chat_id):
-    time.sleep(1800)
-    try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logging.debug(f"Deleted file: {file_path}")
-            bot.send_message(chat_id, f"The file {os.path.basename(file_path)} has been deleted from the server after 30 minutes.")
+# Outbound proxies for extraction and download traffic (PROXY_URLS, PROXY_ROUTES, ...)
+proxy_pool = ProxyPool.from_env()
+proxy_pool.start_health_checks()
+# Quality lookups run on the bot's handler threads, don't hold them long when all proxies are busy
+INTERACTIVE_PROXY_TIMEOUT = int(os.getenv("PROXY_INTERACTIVE_TIMEOUT", 10))
+
+# Fair-share download queue in front of the download pipeline
+download_scheduler = JobScheduler(
+    workers=int(os.getenv("DOWNLOAD_WORKERS", 3)),
+    max_queue_length=int(os.getenv("MAX_QUEUE_LENGTH", 50)),
+)
+download_scheduler.start()
+
+# Live progress through coalesced, rate-limited edits of the status message
+progress_reporter = ProgressReporter(
+    lambda text, chat_id, message_id: bot.edit_message_text(text, chat_id, message_id),
+    chat_interval=float(os.getenv("PROGRESS_EDIT_INTERVAL", 3)),
+    global_rate=float(os.getenv("PROGRESS_EDITS_PER_SECOND", 10)),
+    senders=int(os.getenv("PROGRESS_SENDERS", 4)),
+)
+progress_reporter.start()
+
+def add_progress_hooks(ydl_opts, tracker):
+    ydl_opts['progress_hooks'] = [tracker.progress_hook]
+    ydl_opts['postprocessor_hooks'] = [tracker.postprocessor_hook]
+    return ydl_opts
+
+# Disk-budget admission control for DOWNLOAD_PATH
+DELIVERABLE_TTL = 1800  # Files too large for Telegram are kept for 30 minutes
+STORAGE_WAIT_TIMEOUT = int(os.getenv("STORAGE_WAIT_TIMEOUT", 300))
+STORAGE_RETRY_INTERVAL = int(os.getenv("STORAGE_RETRY_INTERVAL", 15))
+STORAGE_WAIT_TEXT = "Waiting for free disk space, the download will continue shortly..."
+storage_manager = StorageManager(
+    DOWNLOAD_PATH,
+    budget_bytes=int(os.getenv("DOWNLOAD_BUDGET_MB", 0)) * 1024 * 1024 or None,
+    min_free_bytes=int(os.getenv("DOWNLOAD_MIN_FREE_MB", 1024)) * 1024 * 1024,
+)
+storage_manager.start()
+
+def download_with_reservation(ydl, url, extract_audio=False, timeout=STORAGE_WAIT_TIMEOUT, before_download=None,
+                              shrink_caches=True):
+    """Extract url, reserve disk space for the selected formats, then download them.
+
+    ydl is a PooledYoutubeDL; a failed attempt is retried from extraction on
+    another proxy. before_download(expected_bytes) may veto the download by
+    returning False, which returns None. Inside a download_scheduler job a
+    download that doesn't fit raises DeferJob instead of waiting, so neither
+    the worker nor the proxy slot is held while the disk frees up; after
+    timeout seconds of deferrals it fails with StorageFullError.
+    """
+    job = current_job()
+
+    def work(attempt_ydl):
+        info = attempt_ydl.extract_info(url, download=False)
+        ydl.checkpoint()
+        if info.get('_type') == 'playlist':
+            # noplaylist doesn't cover e.g. channel tabs, and the estimate would only cover one video
+            raise ValueError(f"{url} is a playlist, not a single video")
+        expected_bytes, peak_bytes = estimate_download_bytes(info, extract_audio)
+        if before_download is not None and not before_download(expected_bytes):
+            return None
+        if job is None:
+            reservation = storage_manager.reserve(expected_bytes, peak_bytes, timeout=timeout,
+                                                  shrink_caches=shrink_caches)
         else:
-            logging.error(f"File not found: {file_path} - could not delete")
-    except Exception as e:
-        logging.error(f"Error deleting file: {file_path}, Error: {e}")
+            try:
+                reservation = storage_manager.reserve(expected_bytes, peak_bytes, timeout=0,
+                                                      shrink_caches=shrink_caches)
+            except StorageFullError as e:
+                waited = time.monotonic() - (job.deferred_at or time.monotonic())
+                if not e.retryable or waited >= timeout:
+                    raise
+                raise DeferJob(STORAGE_RETRY_INTERVAL, f"Waiting for disk space: {e}")
+        with reservation:
+            attempt_ydl.add_progress_hook(reservation.progress_hook)
+            info = attempt_ydl.process_ie_result(info, download=True)
+            file_path = attempt_ydl.prepare_filename(info)
+            if extract_audio:
+                file_path = os.path.splitext(file_path)[0] + ".mp3"
+            if os.path.exists(file_path):
+                reservation.record_actual(os.path.getsize(file_path))
+        return info
+
+    return ydl.run(work)
+
+# Popularity-driven prefetch of trending videos into a local cache
+# Kept out of DOWNLOAD_PATH, which is served publicly by /downloads/, but on the
+# same disk so cache hits can be hard linked into it
+PREFETCH_PATH = os.getenv("PREFETCH_PATH", "/app/prefetch_cache/")
+popularity_tracker = PopularityTracker(
+    window=int(os.getenv("PREFETCH_WINDOW", 3600)),
+    threshold=int(os.getenv("PREFETCH_THRESHOLD", 5)),
+)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+download_cache = None
+if PREFETCH_ENABLED:
+    download_cache = DownloadCache(PREFETCH_PATH, max_bytes=int(os.getenv("PREFETCH_CACHE_MB", 2048)) * 1024 * 1024)
+    # User downloads may push prefetched files out of the cache when the disk gets tight
+    storage_manager.add_cache(download_cache)
+
+def prefetch_format(key, ratelimit, progress_hook, make_room):
+    """Download a popular (source, video_id, format_id) into the cache directory."""
+    source, video_id, format_id = key
+    quality = "mp3" if format_id == "mp3" else format_id
+    ydl_opts = quality_download_opts(format_id, quality, download_cache.root)
+    ydl_opts.update({'ratelimit': ratelimit, 'progress_hooks': [progress_hook], 'quiet': True})
+    with PooledYoutubeDL(proxy_pool, source, ydl_opts) as ydl:
+        # Never wait for disk space, user downloads have priority
+        info = download_with_reservation(ydl, source_video_url(source, video_id), extract_audio=quality == "mp3",
+                                         timeout=0, before_download=make_room, shrink_caches=False)
+        if info is None:
+            return None
+        file_path = ydl.prepare_filename(info)
+    if quality == "mp3":
+        file_path = os.path.splitext(file_path)[0] + ".mp3"
+    if not os.path.exists(file_path):
+        return None
+    ext = os.path.splitext(file_path)[1]
+    cached_path = os.path.join(download_cache.root, sanitize_filename(f"{source}_{video_id}_{format_id}{ext}"))
+    os.replace(file_path, cached_path)
+    return cached_path, os.path.basename(file_path)
+
+if PREFETCH_ENABLED:
+    prefetcher = Prefetcher(
+        popularity_tracker, download_cache, prefetch_format, download_scheduler.is_idle,
+        ratelimit=int(os.getenv("PREFETCH_RATE_LIMIT_KB", 2048)) * 1024,
+        bytes_per_hour=int(os.getenv("PREFETCH_MB_PER_HOUR", 2048)) * 1024 * 1024,
+    )
+    prefetcher.start()
+
+def serve_from_cache(call, format_id, video_id, quality, source):
+    """Deliver a prefetched file without downloading it. Returns False on a cache miss."""
+    if download_cache is None:
+        return False
+    file_path = download_cache.checkout((source, video_id, format_id), DOWNLOAD_PATH)
+    if file_path is None:
+        return False
+    logging.info("Serving %s %s from the prefetch cache", video_id, format_id)
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    if quality == "mp3":
+        process_audio(file_path, file_size, file_name, call)
+    else:
+        process_file(file_path, file_size, file_name, call)
+    return True
+
+def send_status_message(chat_id, text):
+    """Send a job's status message, or reuse the one from an earlier run of a deferred job."""
+    job = current_job()
+    message = job.context.get('status_message') if job is not None else None
+    if message is None:
+        message = bot.send_message(chat_id, text)
+        if job is not None:
+            job.context['status_message'] = message
+    return message
+
+def get_user_tier(user_id):
+    if user_id in admin_user_ids:
+        return TIER_ADMIN
+    if user_id in verified_user_ids:
+        return TIER_VERIFIED
+    return TIER_FREE
+
+def format_wait(seconds):
+    if seconds < 60:
+        return "less than a minute"
+    minutes = int(round(seconds / 60))
+    return f"about {minutes} minute{'s' if minutes != 1 else ''}"
+
+def notify_job_shed(job):
+    bot.send_message(job.user_id, "The server is very busy right now, so your queued download was cancelled. Please try again in a few minutes.")
+
+def enqueue_download(chat_id, func, *args):
+    """Queue a download job for chat_id and report its queue position back to the chat."""
+    try:
+        job = download_scheduler.submit(chat_id, get_user_tier(chat_id), func, *args, on_shed=notify_job_shed)
+    except QueueFullError:
+        logging.warning("Download queue full, rejecting request from user %s", chat_id)
+        bot.send_message(chat_id, "The download queue is full right now. Please try again in a few minutes.")
+        return None
+
+    position = download_scheduler.position(job)
+    if position is not None:
+        wait = download_scheduler.estimated_wait(job)
+        if wait > 0:
+            bot.send_message(chat_id, f"Your download is queued at position {position}. Estimated wait: {format_wait(wait)}.")
+    return job
+
+def schedule_file_deletion(file_path, chat_id=None):
+    """Keep a file for DELIVERABLE_TTL seconds, it may be evicted earlier when the disk is under pressure."""
+    def on_evict(path, early):
+        if chat_id is None:
+            return
+        try:
+            if early:
+                bot.send_message(chat_id, f"The file {os.path.basename(path)} has been deleted from the server early to free up space.")
+            else:
+                bot.send_message(chat_id, f"The file {os.path.basename(path)} has been deleted from the server after 30 minutes.")
+        except Exception as e:
+            logging.error("Error sending deletion notice for %s: %s", path, e)
+
+    storage_manager.add_deliverable(file_path, ttl=DELIVERABLE_TTL, on_evict=on_evict)
 
 def shorten_url(long_url):
     api_token = os.getenv('ADTIVAL_API_TOKEN')
@@ -61,13 +265,13 @@ def shorten_url(long_url):
             if result['status'] == 'success':
                 return result['shortenedUrl']
             else:
-                logging.error(f"Error from Adtival: {result['message']}")
+                logging.error("Error from Adtival: %s", result['message'])
                 return long_url  # Fallback to the original URL if there's an error
         except json.JSONDecodeError:
             logging.error("Error decoding JSON response from Adtival")
             return long_url  # Fallback to the original URL if there's an error
     else:
-        logging.error(f"Error shortening URL: {response.status_code}")
+        logging.error("Error shortening URL: %s", response.status_code)
         return long_url  # Fallback to the original URL if there's an error
 
 def get_verification_url(filepath):
@@ -106,7 +310,7 @@ def send_video_with_retries(file_path, chat_id, retries=3):
                 bot.send_video(chat_id, video)
             return True
         except Exception as e:
-            logging.error(f"Error uploading video, attempt {attempt + 1}/{retries}: {e}")
+            logging.error("Error uploading video, attempt %s/%s: %s", attempt + 1, retries, e)
             time.sleep(5)
     return False
 
@@ -154,6 +358,20 @@ def download_file(filename):
     except FileNotFoundError:
         return jsonify({"error": "File not found"}), 404
 
+# Flask Route for queue, disk and proxy counters, only enabled when STATUS_TOKEN is set
+STATUS_TOKEN = os.getenv("STATUS_TOKEN")
+
+@app.route('/status')
+def status_route():
+    token = request.headers.get('X-Status-Token', '')
+    if not STATUS_TOKEN or not hmac.compare_digest(token, STATUS_TOKEN):
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({
+        "scheduler": download_scheduler.stats(),
+        "storage": storage_manager.stats(),
+        "proxies": proxy_pool.stats(),
+    })
+
 # Flask Route for Resetting Database
 @app.route('/reset', methods=['POST'])
 def reset_database_route():
@@ -168,7 +386,14 @@ def reset_database_route():
 @bot.message_handler(func=lambda message: True)
 def handle_link(message):
     url = message.text
-    logging.debug(f"Received URL: {url}")
+    logging.debug("Received URL: %s", url)
+
+    links = find_links(message.text)
+    if len(links) > 1 or (links and is_playlist_url(links[0])):
+        bot.reply_to(message, "Collecting the videos from your links, please wait...")
+        enqueue_download(message.chat.id, start_batch, message, links)
+        return
+
     bot.reply_to(message, "Fetching available video qualities, please wait...")
 
     if 'youtube.com' in url or 'youtu.be' in url:
@@ -176,7 +401,7 @@ def handle_link(message):
     elif 'dailymotion.com' in url or 'dai.ly' in url:
         handle_dailymotion_video(url, message)
     elif 'tiktok.com' in url:
-        handle_tiktok_video(url, message)
+        enqueue_download(message.chat.id, handle_tiktok_video, url, message)
     else:
         bot.reply_to(message, "Please send a valid YouTube, Dailymotion, or TikTok link.")
 
@@ -198,8 +423,9 @@ def handle_youtube_video(url, message):
             return
 
         clean_url = f"https://www.youtube.com/watch?v={video_id}"
+        popularity_tracker.record_video('youtube', video_id)
 
-        with YoutubeDL(ydl_opts) as ydl:
+        with PooledYoutubeDL(proxy_pool, 'youtube', ydl_opts, acquire_timeout=INTERACTIVE_PROXY_TIMEOUT) as ydl:
             info = ydl.extract_info(clean_url, download=False)
             formats = info.get('formats', [])
             keyboard = InlineKeyboardMarkup()
@@ -220,24 +446,27 @@ def handle_youtube_video(url, message):
                 bot.reply_to(message, "Choose the video quality:", reply_markup=keyboard)
             else:
                 bot.reply_to(message, "No video qualities available for this link.")
+    except NoProxyAvailable as e:
+        logging.warning("Error fetching video qualities: %s", e)
+        bot.reply_to(message, "The server is busy right now, please try again in a minute.")
     except Exception as e:
-        logging.error(f"Error fetching video qualities: {e}")
+        logging.error("Error fetching video qualities: %s", e)
         bot.reply_to(message, f"Failed to fetch video qualities. Error: {e}")
 
 admin_user_ids = [7951420571, 987654321]  # Replace with actual user IDs
 
 def get_download_link(file_name, resolution, user_id):
     conn = connect_db()
-    logging.info(f"Entered get_download_link for user {user_id}, resolution {resolution}")
+    logging.info("Entered get_download_link for user %s, resolution %s", user_id, resolution)
     ensure_user_in_db(conn, user_id)  # Ensure user exists in the database
 
     if user_id in admin_user_ids:
-        logging.info(f"User {user_id} is an admin, bypassing Adtival")
+        logging.info("User %s is an admin, bypassing Adtival", user_id)
         encoded_file_name = urllib.parse.quote(file_name)
         download_link = f"https://web-production-f9ab3.up.railway.app/downloads/{encoded_file_name}"
     else:
         download_count = get_download_count(conn, user_id)
-        logging.info(f"User {user_id} has download count {download_count}")
+        logging.info("User %s has download count %s", user_id, download_count)
 
         if resolution in ["1440p", "2160p"]:
             logging.info("Resolution is 1440p or 2160p, using Adtival")
@@ -266,11 +495,14 @@ def get_download_link(file_name, resolution, user_id):
 
         increment_download_count(conn, user_id)
     conn.close()
-    logging.info(f"Generated download link: {download_link}")
+    logging.info("Generated download link: %s", download_link)
     return download_link
 
 @bot.message_handler(commands=['download'])
 def handle_download_command(message):
+    enqueue_download(message.chat.id, run_download_command, message)
+
+def run_download_command(message):
     user_id = message.chat.id
     video_url = message.text.split(' ')[1]  # Assuming the format is /download <video_url>
     resolution = "1080p"  # Set resolution based on user input or default to 1080p
@@ -283,8 +515,8 @@ def handle_download_command(message):
         'format': f'bestvideo[height<={resolution}]+bestaudio/best',
         'outtmpl': f'{DOWNLOAD_PATH}%(title)s.%(ext)s',
     }
-    with YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(video_url, download=True)
+    with PooledYoutubeDL(proxy_pool, source_for_url(video_url), ydl_opts) as ydl:
+        info_dict = download_with_reservation(ydl, video_url)
         file_name = ydl.prepare_filename(info_dict)
         file_name = os.path.basename(file_name)  # Get the actual file name
 
@@ -295,7 +527,7 @@ def handle_download_command(message):
 
 def send_download_button(chat_id, file_name, resolution, user_id):
     original_download_link = get_download_link(file_name, resolution, user_id)
-    logging.info(f"Generated download link: {original_download_link}")
+    logging.info("Generated download link: %s", original_download_link)
 
     keyboard = InlineKeyboardMarkup()
     download_button = InlineKeyboardButton(text="Download", url=original_download_link)
@@ -311,8 +543,9 @@ def handle_dailymotion_video(url, message):
     try:
         ydl_opts = {'quiet': True, 'noplaylist': True, 'force_generic_extractor': True}
 
-        with YoutubeDL(ydl_opts) as ydl:
+        with PooledYoutubeDL(proxy_pool, 'dailymotion', ydl_opts, acquire_timeout=INTERACTIVE_PROXY_TIMEOUT) as ydl:
             info = ydl.extract_info(url, download=False)
+            popularity_tracker.record_video('dailymotion', info['id'])
             formats = info.get('formats', [])
             keyboard = InlineKeyboardMarkup()
             quality_set = set()
@@ -333,8 +566,11 @@ def handle_dailymotion_video(url, message):
                 bot.reply_to(message, "Choose the video quality:", reply_markup=keyboard)
             else:
                 bot.reply_to(message, "No video qualities available for this link.")
+    except NoProxyAvailable as e:
+        logging.warning("Error fetching video qualities: %s", e)
+        bot.reply_to(message, "The server is busy right now, please try again in a minute.")
     except Exception as e:
-        logging.error(f"Error fetching video qualities: {e}")
+        logging.error("Error fetching video qualities: %s", e)
         bot.reply_to(message, f"Failed to fetch video qualities. Error: {e}")
 
 def check_tiktok_accessibility():
@@ -350,7 +586,9 @@ def check_tiktok_accessibility():
 def handle_tiktok_video(url, message):
     chat_id = message.chat.id
     try:
-        logging.debug(f"Starting to download TikTok video: {url}")
+        logging.debug("Starting to download TikTok video: %s", url)
+        status_message = send_status_message(chat_id, "Downloading TikTok video, please wait...")
+        tracker = progress_reporter.track(chat_id, status_message.message_id, "Downloading TikTok video")
 
         ydl_opts = {
             'format': 'best',
@@ -367,157 +605,209 @@ def handle_tiktok_video(url, message):
                 'Referer': 'https://www.tiktok.com/',
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             },
-            'verbose': True,
-            'logger': logging.getLogger()
+            'verbose': YTDLP_VERBOSE,
+            'logger': logging.getLogger('yt_dlp')
         }
-
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            logging.debug(f"Video info: {info}")
+        add_progress_hooks(ydl_opts, tracker)
+
+        with PooledYoutubeDL(proxy_pool, 'tiktok', ydl_opts) as ydl:
+            try:
+                info = download_with_reservation(ydl, url)
+            except DeferJob:
+                tracker.finish(STORAGE_WAIT_TEXT)
+                raise
+            except Exception:
+                tracker.finish()
+                raise
+            tracker.finish("Download complete, sending the file...")
+            logging.debug("Video info: id=%s title=%s", info.get('id'), info.get('title'))
 
             file_path = ydl.prepare_filename(info)
-            logging.debug(f"File path: {file_path}")
+            logging.debug("File path: %s", file_path)
 
             base_filepath, ext = os.path.splitext(file_path)
             unique_filepath = get_unique_filepath(base_filepath, ext)
 
             if os.path.exists(file_path):
                 os.rename(file_path, unique_filepath)
-                logging.debug(f"File renamed to: {unique_filepath}")
+                logging.debug("File renamed to: %s", unique_filepath)
 
             file_name = os.path.basename(unique_filepath)
 
             if os.path.exists(unique_filepath):
                 file_size = os.path.getsize(unique_filepath)
-                logging.debug(f"Downloaded file size: {file_size}")
+                logging.debug("Downloaded file size: %s", file_size)
 
                 if file_size <= TELEGRAM_UPLOAD_LIMIT:
                     if send_video_with_retries(unique_filepath, chat_id):
-                        os.remove(unique_filepath)
-                        logging.debug(f"Deleted file after upload: {unique_filepath}")
+                        storage_manager.remove_file(unique_filepath)
+                        logging.debug("Deleted file after upload: %s", unique_filepath)
                     else:
                         logging.error("Failed to upload video after multiple attempts")
                         bot.send_message(chat_id, "Failed to upload video after multiple attempts.")
                 else:
                     send_download_button(chat_id, file_name)
-                    threading.Thread(target=delete_file_after_delay, args=(unique_filepath, chat_id)).start()
+                    schedule_file_deletion(unique_filepath, chat_id)
             else:
-                logging.error(f"File not found: {unique_filepath}")
+                logging.error("File not found: %s", unique_filepath)
                 bot.send_message(chat_id, "Failed to download video. File not found after download.")
+    except DeferJob:
+        raise
+    except StorageFullError as e:
+        logging.warning("Rejected TikTok download for user %s: %s", chat_id, e)
+        bot.send_message(chat_id, "The server is out of storage space right now. Please try again in a few minutes.")
     except Exception as e:
-        logging.error(f"Error during video processing: {e}", exc_info=True)
+        logging.error("Error during video processing: %s", e, exc_info=True)
         bot.send_message(chat_id, "Failed to download video. Currently, TikTok downloads are unavailable due to regional restrictions. Our servers are located in the US, where TikTok has imposed stricter access controls. This means we're currently unable to download TikTok videos. We apologize for the inconvenience and appreciate your understanding.")
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_quality_callback(call):
-    logging.debug(f"Quality callback data: {call.data}")
+    logging.debug("Quality callback data: %s", call.data)
     try:
         data = call.data.split('|')
-        logging.debug(f"Parsed callback data: {data}")
+        logging.debug("Parsed callback data: %s", data)
 
         if len(data) < 4:
             raise ValueError("Incomplete callback data received.")
 
         format_id, video_id, quality, source = data
+        popularity_tracker.record_format(source, video_id, format_id)
+        enqueue_download(call.message.chat.id, download_selected_quality, call, format_id, video_id, quality, source)
+    except ValueError as ve:
+        logging.error("ValueError: %s", ve)
+        bot.send_message(call.message.chat.id, f"Error processing video quality: {ve}")
 
-        if source == 'dailymotion':
-            url = f"https://www.dailymotion.com/video/{video_id}"
-        elif source == 'youtube':
-            url = f"https://www.youtube.com/watch?v={video_id}"
-        else:
-            url = f"https://www.tiktok.com/@{video_id}"
+def source_video_url(source, video_id):
+    if source == 'dailymotion':
+        return f"https://www.dailymotion.com/video/{video_id}"
+    elif source == 'youtube':
+        return f"https://www.youtube.com/watch?v={video_id}"
+    else:
+        return f"https://www.tiktok.com/@{video_id}"
+
+def quality_download_opts(format_id, quality, download_dir):
+    """yt-dlp options for a quality picked from the keyboard."""
+    if quality == "mp3":
+        return {
+            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(download_dir, '%(title)s.%(ext)s'),
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+            'noplaylist': True,
+            'cookies': COOKIES_PATH  # Add the path to your cookies file
+        }
+    return {
+        'format': f'{format_id}+bestaudio/best',
+        'outtmpl': os.path.join(download_dir, '%(title)s_%(format_id)s.%(ext)s'),
+        'noplaylist': True,
+        'merge_output_format': 'mp4',
+        'cookies': COOKIES_PATH  # Add the path to your cookies file
+    }
 
-        logging.debug(f"Downloading video from URL: {url}")
+def download_selected_quality(call, format_id, video_id, quality, source):
+    try:
+        # Cache hits go through the queue too, uploads are slow and fair share still applies
+        if serve_from_cache(call, format_id, video_id, quality, source):
+            return
+        url = source_video_url(source, video_id)
+        logging.debug("Downloading video from URL: %s", url)
 
         if quality == "mp3":
-            bot.send_message(call.message.chat.id, "Converting audio to MP3, please wait...")
-
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': os.path.join(DOWNLOAD_PATH, '%(title)s.%(ext)s'),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'noplaylist': True,
-                'cookies': COOKIES_PATH  # Add the path to your cookies file
-            }
-
-            with YoutubeDL(ydl_opts) as ydl:
+            status_message = send_status_message(call.message.chat.id, "Converting audio to MP3, please wait...")
+            tracker = progress_reporter.track(call.message.chat.id, status_message.message_id, "Downloading audio")
+
+            ydl_opts = add_progress_hooks(quality_download_opts(format_id, quality, DOWNLOAD_PATH), tracker)
+
+            with PooledYoutubeDL(proxy_pool, source, ydl_opts) as ydl:
                 logging.debug("Downloading and converting audio")
-                info = ydl.extract_info(url, download=True)
-                logging.debug(f"Downloaded info: {info}")
+                try:
+                    info = download_with_reservation(ydl, url, extract_audio=True)
+                except DeferJob:
+                    tracker.finish(STORAGE_WAIT_TEXT)
+                    raise
+                except Exception:
+                    tracker.finish()
+                    raise
+                tracker.finish("Download complete, sending the file...")
+                logging.debug("Downloaded info: id=%s title=%s", info.get('id'), info.get('title'))
                 file_path = ydl.prepare_filename(info)
-                logging.debug(f"Prepared file path: {file_path}")
+                logging.debug("Prepared file path: %s", file_path)
 
                 # Ensure the MP3 file path is correct
                 base_filepath, ext = os.path.splitext(file_path)
                 mp3_filepath = base_filepath + ".mp3"
-                logging.debug(f"MP3 file path: {mp3_filepath}")
+                logging.debug("MP3 file path: %s", mp3_filepath)
 
                 # Check if the MP3 file exists
                 if os.path.exists(mp3_filepath):
                     file_name = os.path.basename(mp3_filepath)
                     file_size = os.path.getsize(mp3_filepath)
-                    logging.debug(f"MP3 file size: {file_size}")
+                    logging.debug("MP3 file size: %s", file_size)
 
                     process_audio(mp3_filepath, file_size, file_name, call)
                 else:
-                    logging.error(f"File not found: {mp3_filepath}")
+                    logging.error("File not found: %s", mp3_filepath)
                     bot.send_message(call.message.chat.id, "Failed to download audio. File not found after download.")
         else:
-            bot.send_message(call.message.chat.id, f"Downloading video in {quality}, please wait...")
-
-            ydl_opts = {
-                'format': f'{format_id}+bestaudio/best',
-                'outtmpl': os.path.join(DOWNLOAD_PATH, '%(title)s_%(format_id)s.%(ext)s'),
-                'noplaylist': True,
-                'merge_output_format': 'mp4',
-                'cookies': COOKIES_PATH  # Add the path to your cookies file
-            }
-
-            with YoutubeDL(ydl_opts) as ydl:
-                logging.debug(f"Starting video download with options: {ydl_opts}")
-                info = ydl.extract_info(url, download=True)
-                logging.debug(f"Downloaded video info: {info}")
+            status_message = send_status_message(call.message.chat.id, f"Downloading video in {quality}, please wait...")
+            tracker = progress_reporter.track(call.message.chat.id, status_message.message_id, f"Downloading video in {quality}")
+
+            ydl_opts = add_progress_hooks(quality_download_opts(format_id, quality, DOWNLOAD_PATH), tracker)
+
+            with PooledYoutubeDL(proxy_pool, source, ydl_opts) as ydl:
+                logging.debug("Starting video download with format %s", ydl_opts['format'])
+                try:
+                    info = download_with_reservation(ydl, url)
+                except DeferJob:
+                    tracker.finish(STORAGE_WAIT_TEXT)
+                    raise
+                except Exception:
+                    tracker.finish()
+                    raise
+                tracker.finish("Download complete, sending the file...")
+                logging.debug("Downloaded video info: id=%s title=%s format=%s", info.get('id'), info.get('title'), info.get('format_id'))
                 file_path = ydl.prepare_filename(info)
-                logging.debug(f"Prepared file path: {file_path}")
+                logging.debug("Prepared file path: %s", file_path)
                 base_filepath, ext = os.path.splitext(file_path)
-                logging.debug(f"Base file path: {base_filepath}, Extension: {ext}")
+                logging.debug("Base file path: %s, Extension: %s", base_filepath, ext)
                 unique_filepath = get_unique_filepath(base_filepath, ext)
-                logging.debug(f"Unique file path: {unique_filepath}")
+                logging.debug("Unique file path: %s", unique_filepath)
 
                 if os.path.exists(file_path):
                     os.rename(file_path, unique_filepath)
-                    logging.debug(f"Renamed file to unique path: {unique_filepath}")
+                    logging.debug("Renamed file to unique path: %s", unique_filepath)
 
                 file_name = os.path.basename(unique_filepath)
 
                 if os.path.exists(unique_filepath):
                     file_size = os.path.getsize(unique_filepath)
-                    logging.debug(f"Downloaded file size: {file_size}")
+                    logging.debug("Downloaded file size: %s", file_size)
 
                     process_file(unique_filepath, file_size, file_name, call)
                 else:
-                    logging.error(f"File not found after download: {unique_filepath}")
+                    logging.error("File not found after download: %s", unique_filepath)
                     bot.send_message(call.message.chat.id, "Failed to download video. File not found after download.")
-    except ValueError as ve:
-        logging.error(f"ValueError: {ve}")
-        bot.send_message(call.message.chat.id, f"Error processing video quality: {ve}")
+    except DeferJob:
+        raise
+    except StorageFullError as e:
+        logging.warning("Rejected download for user %s: %s", call.message.chat.id, e)
+        bot.send_message(call.message.chat.id, "The server is out of storage space right now. Please try again in a few minutes.")
     except Exception as e:
-        logging.error(f"Error during video processing: {e}")
+        logging.error("Error during video processing: %s", e)
         bot.send_message(call.message.chat.id, f"Failed to download video. Error: {e}")
 
 def process_audio(unique_filepath, file_size, file_name, call):
     if os.path.exists(unique_filepath):
-        logging.debug(f"File exists: {unique_filepath}")
+        logging.debug("File exists: %s", unique_filepath)
         
         if file_size <= TELEGRAM_UPLOAD_LIMIT:
             if send_audio_with_retries(unique_filepath, call.message.chat.id):
                 if os.path.exists(unique_filepath):
-                    os.remove(unique_filepath)
-                    logging.debug(f"Deleted file after upload: {unique_filepath}")
+                    storage_manager.remove_file(unique_filepath)
+                    logging.debug("Deleted file after upload: %s", unique_filepath)
             else:
                 logging.error("Failed to upload audio after multiple attempts")
                 bot.send_message(call.message.chat.id, "Failed to upload audio after multiple attempts.")
@@ -530,19 +820,186 @@ def process_audio(unique_filepath, file_size, file_name, call):
                 f"{short_download_link}\n\n"
                 "Please download the file within 30 minutes. The file will be deleted from the server after 30 minutes to keep the server clean and efficient."
             ))
-            threading.Thread(target=delete_file_after_delay, args=(unique_filepath, call.message.chat.id)).start()
+            schedule_file_deletion(unique_filepath, call.message.chat.id)
     else:
-        logging.error(f"File not found: {unique_filepath}")
+        logging.error("File not found: %s", unique_filepath)
         bot.send_message(call.message.chat.id, "Failed to find the MP3 file after conversion.")
 
+# Batch mode: several links or a whole playlist/channel in one message
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 25))
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", 3))
+BATCH_FORMAT = os.getenv("BATCH_FORMAT", "bestvideo[height<=720]+bestaudio/best[height<=720]/best")
+BATCH_ITEM_TTL = 7200  # Finished items wait on disk until the whole batch is delivered
+MEDIA_GROUP_SIZE = 10  # Telegram allows at most 10 items per media group
+
+def start_batch(message, links):
+    chat_id = message.chat.id
+    try:
+        urls = expand_links(links, BATCH_MAX_ITEMS, proxy_pool)
+    except Exception as e:
+        logging.error("Error expanding batch links: %s", e)
+        bot.send_message(chat_id, f"Failed to read the videos from your links. Error: {e}")
+        return
+    if not urls:
+        bot.send_message(chat_id, "No videos found in your links.")
+        return
+
+    # Every item counts against the same daily limit as a single download. The
+    # quota is taken up front, so batches sent together can't all see the same
+    # allowance; deliver_batch refunds the items that fail.
+    if chat_id not in admin_user_ids:
+        conn = connect_db()
+        ensure_user_in_db(conn, chat_id)
+        allowance = reserve_download_count(conn, chat_id, len(urls), 2)
+        conn.close()
+        if allowance < len(urls):
+            bot.send_message(chat_id, (
+                f"You can download {allowance} more video{'s' if allowance != 1 else ''} today, so only the first {allowance} "
+                f"of {len(urls)} will be downloaded. The daily limit is 2 videos; verify to download more."
+            ))
+            urls = urls[:allowance]
+            if not urls:
+                return
+
+    status_message = bot.send_message(chat_id, f"Downloading {len(urls)} videos, please wait...")
+    tracker = progress_reporter.track(chat_id, status_message.message_id, f"Downloading {len(urls)} videos")
+
+    def submit(item):
+        download_scheduler.submit(
+            chat_id, get_user_tier(chat_id), download_batch_item, batch, item,
+            on_shed=lambda job: batch.item_done(item, error="dropped because the server is busy"),
+        )
+
+    def report_progress(batch):
+        tracker.update(f"Downloading {len(batch.items)} videos...\n{batch.done_count()}/{len(batch.items)} done")
+
+    batch = Batch(chat_id, urls, submit, lambda batch: deliver_batch(batch, tracker),
+                  on_progress=report_progress, parallelism=BATCH_PARALLELISM)
+    batch.start()
+
+def download_batch_item(batch, item):
+    ydl_opts = {
+        'format': BATCH_FORMAT,
+        'outtmpl': os.path.join(DOWNLOAD_PATH, f'%(title)s_%(id)s_{batch.user_id}.%(ext)s'),
+        'noplaylist': True,
+        'merge_output_format': 'mp4',
+        'cookies': COOKIES_PATH,
+        'quiet': True,
+    }
+    try:
+        with PooledYoutubeDL(proxy_pool, source_for_url(item.url), ydl_opts) as ydl:
+            info = download_with_reservation(ydl, item.url)
+            file_path = ydl.prepare_filename(info)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError("File not found after download")
+    except DeferJob:
+        raise
+    except Exception as e:
+        logging.error("Error downloading batch item %s: %s", item.url, e)
+        batch.item_done(item, error=str(e))
+        return
+
+    # Tracked until delivery, so it is deleted even if the batch never gets there
+    storage_manager.add_deliverable(file_path, ttl=BATCH_ITEM_TTL)
+    if batch.user_id in admin_user_ids:
+        conn = connect_db()
+        if conn is not None:
+            increment_download_count(conn, batch.user_id)
+            conn.close()
+    batch.item_done(item, file_path=file_path)
+
+def deliver_batch(batch, tracker):
+    chat_id = batch.user_id
+    items = batch.succeeded()
+    try:
+        for item in items:
+            if not os.path.exists(item.file_path):
+                item.error = "deleted from the server before delivery"
+        items = [item for item in items if not item.error]
+        failed = batch.failed()
+        if failed and chat_id not in admin_user_ids:
+            conn = connect_db()
+            if conn is not None:
+                refund_download_count(conn, chat_id, len(failed))
+                conn.close()
+        tracker.finish(f"Downloaded {len(items)} of {len(batch.items)} videos.")
+
+        if items:
+            paths = [item.file_path for item in items]
+            sizes = [os.path.getsize(path) for path in paths]
+            if max(sizes) <= TELEGRAM_UPLOAD_LIMIT:
+                send_media_groups(chat_id, paths)
+            else:
+                send_batch_archive(chat_id, paths, sum(sizes))
+
+        if failed:
+            lines = "\n".join(f"- {item.url}: {item.error}" for item in failed[:10])
+            bot.send_message(chat_id, f"{len(failed)} of the videos could not be downloaded:\n{lines}")
+    finally:
+        for item in batch.succeeded():
+            try:
+                storage_manager.remove_file(item.file_path)
+            except OSError as e:
+                logging.error("Error deleting batch item %s: %s", item.file_path, e)
+
+def send_media_groups(chat_id, paths):
+    for start in range(0, len(paths), MEDIA_GROUP_SIZE):
+        group = paths[start:start + MEDIA_GROUP_SIZE]
+        # Telegram only accepts media groups of 2 to 10 items
+        sent = len(group) > 1 and send_media_group(chat_id, group)
+        if not sent:
+            for path in group:
+                if not send_video_with_retries(path, chat_id):
+                    bot.send_message(chat_id, f"Failed to upload {os.path.basename(path)} after multiple attempts.")
+        for path in group:
+            storage_manager.remove_file(path)
+
+def send_media_group(chat_id, group):
+    files = [open(path, 'rb') for path in group]
+    try:
+        bot.send_media_group(chat_id, [InputMediaVideo(f) for f in files])
+        return True
+    except Exception as e:
+        logging.error("Error uploading media group, sending videos one by one: %s", e)
+        return False
+    finally:
+        for f in files:
+            f.close()
+
+def send_batch_archive(chat_id, paths, total_size):
+    archive_path = get_unique_filepath(os.path.join(DOWNLOAD_PATH, f"videos_{chat_id}_{int(time.time())}"), ".zip")
+    try:
+        with storage_manager.reserve(total_size, timeout=STORAGE_WAIT_TIMEOUT) as reservation:
+            write_archive(archive_path, paths)
+            reservation.record_actual(os.path.getsize(archive_path))
+    except Exception as e:
+        logging.error("Error creating batch archive %s: %s", archive_path, e)
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        bot.send_message(chat_id, "Failed to pack your videos into an archive. Please try again later.")
+        return
+    finally:
+        for path in paths:
+            storage_manager.remove_file(path)
+
+    schedule_file_deletion(archive_path, chat_id)
+    encoded_file_name = urllib.parse.quote(os.path.basename(archive_path))
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton(text="Download", url=f"https://web-production-f9ab3.up.railway.app/downloads/{encoded_file_name}"))
+    bot.send_message(chat_id, (
+        "Your videos are too large to upload to Telegram, so they have been packed into one archive. "
+        "You can download it using the button below.\n\n"
+        "Please download the file within 30 minutes. The file will be deleted from the server after 30 minutes to keep the server clean and efficient."
+    ), reply_markup=keyboard)
+
 def send_audio_with_retries(file_path, chat_id, retries=3):
     for attempt in range(retries):
         try:
             bot.send_audio(chat_id, audio=open(file_path, 'rb'))
-            logging.debug(f"Successfully sent audio: {file_path}")
+            logging.debug("Successfully sent audio: %s", file_path)
             return True
         except Exception as e:
-            logging.error(f"Failed to send audio (Attempt {attempt + 1}): {e}")
+            logging.error("Failed to send audio (Attempt %s): %s", attempt + 1, e)
             if attempt < retries - 1:
                 time.sleep(2)  # Wait before retrying
     return False
@@ -575,15 +1032,15 @@ def process_file(unique_filepath, file_size, file_name, call):
         file_name = sanitize_and_encode_filename(file_name)
         if file_size <= TELEGRAM_UPLOAD_LIMIT:
             if send_video_with_retries(unique_filepath, call.message.chat.id):
-                os.remove(unique_filepath)
-                logging.debug(f"Deleted file after upload: {unique_filepath}")
+                storage_manager.remove_file(unique_filepath)
+                logging.debug("Deleted file after upload: %s", unique_filepath)
                 increment_download_count(conn, user_id)
             else:
                 logging.error("Failed to upload video after multiple attempts")
                 bot.send_message(call.message.chat.id, "Failed to upload video after multiple attempts.")
         else:
             send_download_button(call.message.chat.id, file_name, resolution, user_id)
-            threading.Thread(target=delete_file_after_delay, args=(unique_filepath, call.message.chat.id)).start()
+            schedule_file_deletion(unique_filepath, call.message.chat.id)
     else:
         # Require verification after two downloads
         verification_url = get_verification_url(file_name)  # Use sanitized filename
@@ -604,7 +1061,7 @@ def send_video_with_retries(file_path, chat_id, retries=3):
                 bot.send_video(chat_id, video)
             return True
         except Exception as e:
-            logging.error(f"Error uploading video, attempt {attempt + 1}/{retries}: {e}")
+            logging.error("Error uploading video, attempt %s/%s: %s", attempt + 1, retries, e)
             time.sleep(5)
     return False
 
@@ -613,10 +1070,10 @@ def start_polling():
         try:
             bot.polling(none_stop=True, timeout=60)
         except requests.exceptions.ReadTimeout as e:
-            logging.error(f"ReadTimeoutError: {e}, retrying in 15 seconds...")
+            logging.error("ReadTimeoutError: %s, retrying in 15 seconds...", e)
             time.sleep(15)
         except Exception as e:
-            logging.error(f"Exception occurred: {e}, retrying in 15 seconds...")
+            logging.error("Exception occurred: %s, retrying in 15 seconds...", e)
             time.sleep(15)
 
 # Start polling for the bot in a thread with retry mechanism
@@ -640,7 +1097,7 @@ def download():
     if not url:
         return jsonify({"error": "URL parameter is missing"}), 400
 
-    logging.debug(f"Received download request: url={url}, quality={quality}, source={source}")
+    logging.debug("Received download request: url=%s, quality=%s, source=%s", url, quality, source)
 
     try:
         file_path, file_name = download_video(url, quality, source)
@@ -649,7 +1106,7 @@ def download():
         else:
             return jsonify({"status": "error", "message": "Failed to download video"}), 500
     except Exception as e:
-        logging.error(f"Error downloading video: {e}")
+        logging.error("Error downloading video: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # Flask helper functions
@@ -662,27 +1119,27 @@ def download_video(url, quality, source):
             'cookies': COOKIES_PATH  # Ensure the path to the cookies file is correct
         }
 
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        with PooledYoutubeDL(proxy_pool, source_for_url(url), ydl_opts) as ydl:
+            info = download_with_reservation(ydl, url)
             file_path = ydl.prepare_filename(info)
             base_filepath, ext = os.path.splitext(file_path)
             unique_filepath = get_unique_filepath(base_filepath, ext)
 
             if os.path.exists(file_path):
                 os.rename(file_path, unique_filepath)
-                logging.debug(f"Renamed file to unique path: {unique_filepath}")
+                logging.debug("Renamed file to unique path: %s", unique_filepath)
             else:
-                logging.error(f"File not found after download: {file_path}")
+                logging.error("File not found after download: %s", file_path)
                 return None, None
 
             file_name = os.path.basename(unique_filepath)
             file_size = os.path.getsize(unique_filepath)
-            logging.debug(f"Downloaded file size: {file_size}")
+            logging.debug("Downloaded file size: %s", file_size)
 
-            threading.Thread(target=delete_file_after_delay, args=(unique_filepath,)).start()
+            schedule_file_deletion(unique_filepath)
             return unique_filepath, file_name
     except Exception as e:
-        logging.error(f"Error during video download: {e}")
+        logging.error("Error during video download: %s", e)
         return None, None
 
 if __name__ == '__main__':